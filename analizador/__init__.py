@@ -2,15 +2,15 @@
 # Este archivo inicializa la aplicación Flask y sus extensiones (Application Factory).
 
 import os
+from functools import lru_cache
 from flask import Flask
 from dotenv import load_dotenv
 from influxdb_client import InfluxDBClient
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_mail import Mail
-
-# Cargar variables de entorno desde el archivo .env
-load_dotenv()
+from flask_caching import Cache
+from itsdangerous import URLSafeTimedSerializer
 
 # --- Base de Datos de Usuarios (SQLAlchemy) ---
 db = SQLAlchemy()
@@ -18,40 +18,111 @@ db = SQLAlchemy()
 # Mail para reset de contraseña
 mail = Mail()
 
-# --- Configuración de InfluxDB ---
-INFLUXDB_URL = os.getenv('INFLUXDB_URL')
-INFLUXDB_TOKEN = os.getenv('INFLUXDB_TOKEN')
-INFLUXDB_ORG = os.getenv('INFLUXDB_ORG')
-INFLUXDB_BUCKET = os.getenv('INFLUXDB_BUCKET')
-
-
-# Cliente global de InfluxDB
-influx_client = InfluxDBClient(url=INFLUXDB_URL, token=INFLUXDB_TOKEN, org=INFLUXDB_ORG, timeout=60_000, enable_gzip=True)
-
-# === InfluxDB de Clima (REMOTO/PRODUCCIÓN) ===
-WEATHER_INFLUX_URL = os.getenv('WEATHER_INFLUX_URL') or INFLUXDB_URL
-WEATHER_INFLUX_TOKEN = os.getenv('WEATHER_INFLUX_TOKEN') or INFLUXDB_TOKEN
-WEATHER_INFLUX_ORG = os.getenv('WEATHER_INFLUX_ORG') or INFLUXDB_ORG
-WEATHER_INFLUX_BUCKET = os.getenv('WEATHER_INFLUX_BUCKET', 'weather')
-
-WEATHER_MEASUREMENT  = os.getenv('WEATHER_MEASUREMENT', 'weather_hourly')
-WEATHER_WIND_FIELD   = os.getenv('WEATHER_WIND_FIELD', 'windspeed')
-WEATHER_HUM_FIELD    = os.getenv('WEATHER_HUM_FIELD', 'relative_humidity')
-WEATHER_TEMP_FIELD   = os.getenv('WEATHER_TEMP_FIELD', 'temperature')
-WEATHER_SITE_TAG_KEY = os.getenv('WEATHER_SITE_TAG_KEY', 'site_tag')
-
-weather_influx_client = InfluxDBClient(
-    url=WEATHER_INFLUX_URL,
-    token=WEATHER_INFLUX_TOKEN,
-    org=WEATHER_INFLUX_ORG,
-    timeout=60_000,
-    enable_gzip=True,
-)
+# Caché en memoria para consultas repetidas a InfluxDB (opciones de filtro, fechas)
+cache = Cache()
+
+# --- Configuración de InfluxDB y Clima ---
+# Se completan en create_app() vía _load_settings(): importar el paquete no lee .env ni
+# el entorno. Los blueprints/servicios se importan dentro de create_app(), después.
+INFLUXDB_URL = INFLUXDB_TOKEN = INFLUXDB_ORG = INFLUXDB_BUCKET = None
+INFLUXDB_POOL_SIZE = 50
+
+WEATHER_INFLUX_URL = WEATHER_INFLUX_TOKEN = WEATHER_INFLUX_ORG = None
+WEATHER_INFLUX_BUCKET = 'weather'
+
+WEATHER_MEASUREMENT  = 'weather_hourly'
+WEATHER_WIND_FIELD   = 'windspeed'
+WEATHER_HUM_FIELD    = 'relative_humidity'
+WEATHER_TEMP_FIELD   = 'temperature'
+WEATHER_SITE_TAG_KEY = 'site_tag'
+
+_settings_loaded = False
+
+def _load_settings():
+    """Carga .env y lee las variables de entorno una única vez por proceso."""
+    global _settings_loaded
+    global INFLUXDB_URL, INFLUXDB_TOKEN, INFLUXDB_ORG, INFLUXDB_BUCKET, INFLUXDB_POOL_SIZE
+    global WEATHER_INFLUX_URL, WEATHER_INFLUX_TOKEN, WEATHER_INFLUX_ORG, WEATHER_INFLUX_BUCKET
+    global WEATHER_MEASUREMENT, WEATHER_WIND_FIELD, WEATHER_HUM_FIELD, WEATHER_TEMP_FIELD, WEATHER_SITE_TAG_KEY
+    if _settings_loaded:
+        return
+    load_dotenv()
+    env = dict(os.environ)
+
+    INFLUXDB_URL = env.get('INFLUXDB_URL')
+    INFLUXDB_TOKEN = env.get('INFLUXDB_TOKEN')
+    INFLUXDB_ORG = env.get('INFLUXDB_ORG')
+    INFLUXDB_BUCKET = env.get('INFLUXDB_BUCKET')
+
+    # Conexiones HTTP reutilizables por cliente (urllib3 usa 10 si no se indica)
+    INFLUXDB_POOL_SIZE = int(env.get('INFLUXDB_POOL_SIZE', '50'))
+
+    # === InfluxDB de Clima (REMOTO/PRODUCCIÓN) ===
+    WEATHER_INFLUX_URL = env.get('WEATHER_INFLUX_URL') or INFLUXDB_URL
+    WEATHER_INFLUX_TOKEN = env.get('WEATHER_INFLUX_TOKEN') or INFLUXDB_TOKEN
+    WEATHER_INFLUX_ORG = env.get('WEATHER_INFLUX_ORG') or INFLUXDB_ORG
+    WEATHER_INFLUX_BUCKET = env.get('WEATHER_INFLUX_BUCKET', WEATHER_INFLUX_BUCKET)
+
+    WEATHER_MEASUREMENT  = env.get('WEATHER_MEASUREMENT', WEATHER_MEASUREMENT)
+    WEATHER_WIND_FIELD   = env.get('WEATHER_WIND_FIELD', WEATHER_WIND_FIELD)
+    WEATHER_HUM_FIELD    = env.get('WEATHER_HUM_FIELD', WEATHER_HUM_FIELD)
+    WEATHER_TEMP_FIELD   = env.get('WEATHER_TEMP_FIELD', WEATHER_TEMP_FIELD)
+    WEATHER_SITE_TAG_KEY = env.get('WEATHER_SITE_TAG_KEY', WEATHER_SITE_TAG_KEY)
+    _settings_loaded = True
+
+# Los clientes se crean al primer uso y uno por PID: tras el fork() de Gunicorn cada
+# worker abre su propio pool de conexiones en lugar de heredar los sockets del master.
+@lru_cache(maxsize=1)
+def _influx_client_for(pid):
+    return InfluxDBClient(
+        url=INFLUXDB_URL,
+        token=INFLUXDB_TOKEN,
+        org=INFLUXDB_ORG,
+        timeout=60_000,
+        enable_gzip=True,
+        connection_pool_maxsize=INFLUXDB_POOL_SIZE,
+    )
+
+@lru_cache(maxsize=1)
+def _weather_influx_client_for(pid):
+    return InfluxDBClient(
+        url=WEATHER_INFLUX_URL,
+        token=WEATHER_INFLUX_TOKEN,
+        org=WEATHER_INFLUX_ORG,
+        timeout=60_000,
+        enable_gzip=True,
+        connection_pool_maxsize=INFLUXDB_POOL_SIZE,
+    )
+
+def get_influx_client():
+    """Cliente de InfluxDB de incidencias para el proceso actual."""
+    return _influx_client_for(os.getpid())
+
+# QueryApi no guarda estado por consulta: una por cliente (y por proceso) alcanza
+@lru_cache(maxsize=1)
+def _query_api_for(pid):
+    return _influx_client_for(pid).query_api()
+
+@lru_cache(maxsize=1)
+def _weather_query_api_for(pid):
+    return _weather_influx_client_for(pid).query_api()
+
+def get_query_api():
+    """QueryApi compartida del InfluxDB de incidencias para el proceso actual."""
+    return _query_api_for(os.getpid())
+
+def get_weather_query_api():
+    """QueryApi compartida del InfluxDB de clima para el proceso actual."""
+    return _weather_query_api_for(os.getpid())
+
+def flux_str(value):
+    """Literal de string Flux: escapa barras, comillas e interpolación ${...}."""
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('${', '\\${') + '"'
 
 def setup_influxdb():
     """Comprueba si el bucket de InfluxDB existe y lo crea si es necesario."""
     try:
-        bucket_api = influx_client.buckets_api()
+        bucket_api = get_influx_client().buckets_api()
         bucket = bucket_api.find_bucket_by_name(INFLUXDB_BUCKET)
         if not bucket:
             print(f"Bucket '{INFLUXDB_BUCKET}' no encontrado. Creándolo...")
@@ -63,6 +134,9 @@ def setup_influxdb():
 
 def create_app():
     """Crea y configura la instancia de la aplicación Flask."""
+    # Cargar variables de entorno desde el archivo .env
+    _load_settings()
+
     app = Flask(__name__)
     
     app.config['SECRET_KEY'] = 'clave_secreta_muy_segura_cambiar_en_produccion'
@@ -76,6 +150,12 @@ def create_app():
     app.config['MAIL_USERNAME'] = os.getenv('MAIL_USERNAME')
     app.config['MAIL_PASSWORD'] = os.getenv('MAIL_PASSWORD')
     app.config['MAIL_DEFAULT_SENDER'] = os.getenv('MAIL_DEFAULT_SENDER', 'no-reply@example.com')
+
+    # Serializador de tokens de reset: se arma una vez por app, no por request
+    app.extensions['reset_serializer'] = URLSafeTimedSerializer(
+        secret_key=app.config['SECRET_KEY'],
+        salt=app.config.get('SECURITY_PASSWORD_SALT', 'security-salt'),
+    )
     
     # Asegurarse de que la carpeta 'instance' exista para la base de datos SQLite
     try:
@@ -93,6 +173,14 @@ def create_app():
     # Inicializar Mail
     mail.init_app(app)
 
+    # Inicializar Caché (por defecto en memoria del proceso)
+    app.config['CACHE_TYPE'] = os.getenv('CACHE_TYPE', 'SimpleCache')
+    app.config['CACHE_DEFAULT_TIMEOUT'] = int(os.getenv('CACHE_DEFAULT_TIMEOUT', '300'))
+    # Claves por bucket: con un backend compartido (p.ej. Redis) dos despliegues sobre
+    # buckets distintos no se pisan las opciones/fechas cacheadas
+    app.config['CACHE_KEY_PREFIX'] = f'analizador:{INFLUXDB_BUCKET}:'
+    cache.init_app(app)
+
     # Configuración del gestor de sesiones de usuario
     login_manager = LoginManager()
     login_manager.login_view = 'auth.login'
@@ -102,13 +190,20 @@ def create_app():
 
     @login_manager.user_loader
     def load_user(user_id):
-        return User.query.get(int(user_id))
+        return db.session.get(User, int(user_id))
 
     # Configurar la carpeta de subidas de archivos
     upload_path = os.path.join(os.path.dirname(app.instance_path), 'uploads')
     os.makedirs(upload_path, exist_ok=True)
     app.config['UPLOAD_FOLDER'] = upload_path
 
+    # Carpeta de exportaciones XLS; con USE_X_SENDFILE=true el servidor web (nginx/Apache)
+    # envía el archivo en lugar del worker de Python
+    export_path = os.path.join(os.path.dirname(app.instance_path), 'exports')
+    os.makedirs(export_path, exist_ok=True)
+    app.config['EXPORT_FOLDER'] = export_path
+    app.config['USE_X_SENDFILE'] = os.getenv('USE_X_SENDFILE', 'false').lower()=='true'
+
     # Verificar configuración de InfluxDB al iniciar
     if all([INFLUXDB_URL, INFLUXDB_TOKEN, INFLUXDB_ORG, INFLUXDB_BUCKET]):
         setup_influxdb()
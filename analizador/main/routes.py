@@ -2,154 +2,150 @@
 # Rutas principales de la aplicación: panel de control, filtros, descargas, etc.
 
 import os
-import io
+import re
+import tempfile
+import numpy as np
 import pandas as pd
+import xlsxwriter
 import threading
 import pytz
-import math
-from collections import defaultdict, Counter
-from datetime import datetime, date, time, timedelta
-from flask import render_template, request, redirect, url_for, jsonify, current_app, send_file, flash
+import orjson
+from bisect import bisect_left
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, time, timedelta, timezone
+from flask import Response, render_template, request, redirect, url_for, jsonify, current_app, send_file, flash
 from flask_login import login_required, current_user
 from . import main
-from .. import influx_client, INFLUXDB_ORG, INFLUXDB_BUCKET
-from ..services import process_file_to_influxdb
+from .. import get_query_api, cache, flux_str, INFLUXDB_ORG, INFLUXDB_BUCKET
+from ..services import (submit_file_processing, submit_bucket_purge, get_job_status,
+                        reserve_upload, reserve_purge, release_job)
 from ..decorators import admin_required
-#from .. import (
-#    weather_influx_client,
-#    WEATHER_INFLUX_ORG,
-#)
-from .. import weather_influx_client
+from .. import get_weather_query_api
 from ..weather_adapter import load_distrito_tags, cross_incidents_with_weather
 
 # =========================
 # Fechas y zona horaria
 # =========================
 TZ = pytz.timezone("America/Argentina/San_Luis")
+# San Luis está en UTC-3 fijo desde 2009, sin horario de verano. Para convertir cada
+# incidencia alcanza con el offset fijo: localize() de pytz recorre la tabla de
+# transiciones en cada llamada.
+TZ_FIXED = timezone(timedelta(hours=-3))
 
-def _to_local(dt: datetime) -> datetime:
-    if dt is None:
-        return None
-    if dt.tzinfo is None:
-        return TZ.localize(dt)
-    return dt.astimezone(TZ)
-
-
-def _coerce_float(x, default=0.0):
-    try:
-        if x is None:
-            return default
-        if isinstance(x, (int, float)):
-            return float(x)
-        s = str(x).replace(',', '.')
-        return float(s)
-    except Exception:
-        return default
 
+# DD-MM-YYYY, DD/MM/YYYY o YYYY-MM-DD (día y mes de 1 o 2 dígitos, como strptime).
+# Un solo match + int() reemplaza la cadena de strptime que lanzaba ValueError por cada
+# formato que no coincidía.
+_DATE_RE = re.compile(r'(?:(\d{1,2})([-/])(\d{1,2})\2(\d{4})|(\d{4})-(\d{1,2})-(\d{1,2}))\Z')
 
-def _coerce_int(x, default=0):
+def _match_date(s, dmy_seps):
+    """datetime (sin TZ) si `s` es YYYY-MM-DD o DD<sep>MM<sep>YYYY con sep en `dmy_seps`."""
+    m = _DATE_RE.match(s)
+    if m is None:
+        return None
+    d, sep, mo, y, y_iso, mo_iso, d_iso = m.groups()
+    if y_iso:
+        y, mo, d = y_iso, mo_iso, d_iso
+    elif sep not in dmy_seps:
+        return None
     try:
-        if x is None:
-            return default
-        if isinstance(x, (int,)):
-            return int(x)
-        s = str(x).strip()
-        return int(float(s.replace(',', '.')))
-    except Exception:
-        return default
+        return datetime(int(y), int(mo), int(d))
+    except ValueError:
+        return None
 
 def _parse_date_or_none(s):
     if not s:
         return None
-    s = str(s).strip()
-    for fmt in ("%Y-%m-%d", "%d/%m/%Y"):
-        try:
-            return datetime.strptime(s, fmt)
-        except ValueError:
-            pass
-    return None
-
-def _safe_date(s):
-    """Recibe 'YYYY-MM-DD' y devuelve datetime o None."""
-    return _parse_date_or_none(s)
+    return _match_date(str(s).strip(), "/")
 
-def _build_available_end_dates(start_dt):
+def _build_available_end_dates(start_dt, all_dates):
     """
-    Usa tu función existente get_available_dates() (strings 'YYYY-MM-DD')
-    y filtra >= start_dt.
+    Filtra >= start_dt las fechas de get_available_dates() (strings 'YYYY-MM-DD') que
+    la vista ya trajo para el combo 'Desde'.
     """
     if not start_dt:
         return []
-    start_s = start_dt.strftime("%Y-%m-%d")
-    all_dates = get_available_dates()  # ya la usas para el combo 'Desde'
-    return [d for d in all_dates if d >= start_s]
-
-
-def _incident_iter(incidents):
-    """Itera incidentes normalizados con dt_inicio_local, dt_fin_local y dur_min."""
-    for inc in incidents:
-        f_ini = inc.get('fecha_inicio_fmt') or inc.get('fecha_inicio')
-        h_ini = inc.get('hora_inicio_fmt')  or inc.get('hora_inicio')
-        f_fin = inc.get('fecha_fin_fmt')    or inc.get('fecha_fin')
-        h_fin = inc.get('hora_fin_fmt')     or inc.get('hora_fin')
-
-        dt_ini = _parse_datetime_flexible(f_ini, h_ini)
-        dt_fin = _parse_datetime_flexible(f_fin, h_fin)
-        if not dt_ini or not dt_fin:
-            continue
-        dt_ini = _to_local(dt_ini)
-        dt_fin = _to_local(dt_fin)
-        if dt_fin < dt_ini:
-            continue
-        dur_min = max(0, (dt_fin - dt_ini).total_seconds() / 60.0)
-        nivel = inc.get('nivel_tension') or inc.get('nivel_tensión') or inc.get('nivel') or 'N/D'
-        causa = inc.get('descripcion_de_la_causa') or 'Sin causa'
-        nises = _coerce_int(inc.get('nises_involucrados'))
-        pot   = _coerce_float(inc.get('potencia_involucrada'))
-
-        yield {
-            'distrito': str(inc.get('distrito') or inc.get('Distrito') or inc.get('DISTRITO') or '').strip(),
-            'dt_inicio_local': dt_ini,
-            'dt_fin_local': dt_fin,
-            'dur_min': dur_min,
-            'nivel_tension': nivel,
-            'causa': causa,
-            'nises': nises,
-            'potencia': pot,
-        }
+    # Únicas y ordenadas desde InfluxDB: el corte sale por bisección, sin sets ni filtros
+    return all_dates[bisect_left(all_dates, start_dt.strftime("%Y-%m-%d")):]
+
+
+def _text_col(df, name):
+    """Columna como texto ('' donde falta el valor o la columna entera)."""
+    if name not in df.columns:
+        return pd.Series('', index=df.index, dtype=object)
+    return df[name].fillna('').astype(str)
+
+def _num_col(df, name):
+    """Columna numérica; acepta coma decimal en texto. Lo no convertible vale 0."""
+    if name not in df.columns:
+        return pd.Series(0.0, index=df.index)
+    col = df[name]
+    if not pd.api.types.is_numeric_dtype(col):
+        col = pd.to_numeric(col.astype(str).str.replace(',', '.', regex=False), errors='coerce')
+    return col.fillna(0)
+
+# Código de nivel de tensión de _chart_frame (0 = otro / sin dato)
+NIVEL_BT, NIVEL_MT = 1, 2
+NIVEL_CODES = {'BT': NIVEL_BT, 'MT': NIVEL_MT}
+
+def _chart_frame(df):
+    """Incidencias normalizadas para /graficos y el cruce con clima, por columnas:
+    distrito, dt_inicio_local, dt_fin_local, dur_min, nivel_tension (y su código
+    nivel_code), causa, nises y potencia. Se descartan las que terminan antes de empezar."""
+    if df.empty:
+        df = pd.DataFrame({'_time': pd.Series([], dtype='datetime64[ns]').dt.tz_localize('UTC')})
+
+    # Inicio: _time es el inicio real del incidente (ver services.process_file_to_influxdb)
+    ini = df['_time'].dt.tz_convert(TZ_FIXED)
+
+    # Duración: las cargas nuevas la guardan en dur_min; para las anteriores (o filas sin
+    # ese campo) se calcula desde el fin, que la carga guarda como DD-MM-YYYY / HH:MM:SS y
+    # se parsea de una vez; lo que no respete ese formato pasa por el parser flexible
+    if 'dur_min' in df.columns:
+        dur = pd.to_numeric(df['dur_min'], errors='coerce')
+    else:
+        dur = pd.Series(float('nan'), index=df.index)
+    missing = dur.isna()
+    if missing.any():
+        fecha_fin = _text_col(df, 'fecha_fin')[missing]
+        hora_fin = _text_col(df, 'hora_fin')[missing]
+        fin = pd.to_datetime(fecha_fin + ' ' + hora_fin, format='%d-%m-%Y %H:%M:%S', errors='coerce')
+        bad = fin.isna()
+        if bad.any():
+            fin[bad] = [_parse_datetime_flexible(f, h) for f, h in zip(fecha_fin[bad], hora_fin[bad])]
+        fin = fin.dt.tz_localize(TZ_FIXED)
+        dur[missing] = (fin - ini[missing]).dt.total_seconds() / 60.0
+    fin = ini + pd.to_timedelta(dur, unit='m')
+
+    nivel = _text_col(df, 'nivel_tension')
+    out = pd.DataFrame({
+        'distrito': _text_col(df, 'distrito').str.strip(),
+        'dt_inicio_local': ini,
+        'dt_fin_local': fin,
+        'dur_min': dur,
+        'nivel_tension': nivel.replace('', 'N/D'),
+        'nivel_code': nivel.str.upper().map(NIVEL_CODES).fillna(0).astype('int8'),
+        'causa': _text_col(df, 'descripcion_de_la_causa').replace('', 'Sin causa'),
+        'nises': _num_col(df, 'nises_involucrados').astype('int64'),
+        'potencia': _num_col(df, 'potencia_involucrada').astype(float),
+    })
+    return out[out['dur_min'] >= 0].reset_index(drop=True)
 
 def _fetch_incidents_with_filters():
-    sd = _parse_date_flexible(request.args.get('start_date'))
-    ed = _parse_date_flexible(request.args.get('end_date'))
-    start_date = sd.date() if sd else None
-    end_date   = ed.date() if ed else None
+    start_date = _as_date(_parse_date_flexible(request.args.get('start_date')))
+    end_date   = _as_date(_parse_date_flexible(request.args.get('end_date')))
 
     distrito = (request.args.get('distrito') or '').strip() or None
     causa    = (request.args.get('causa') or '').strip() or None
     nivel    = (request.args.get('nivel_tension') or '').strip() or None
 
-    incidents = get_filtered_incidents(start_date, end_date, distrito, causa, nivel)
-    return list(_incident_iter(incidents))
-
-
-def _to_date_any(x):
-    if isinstance(x, datetime): return x.date()
-    if isinstance(x, date):     return x
-    s = str(x).strip() if x is not None else ""
-    for fmt in ("%d-%m-%Y", "%Y-%m-%d", "%d/%m/%Y"):
-        try:
-            return datetime.strptime(s, fmt).date()
-        except ValueError:
-            pass
     try:
-        return datetime.fromisoformat(s).date()
-    except Exception:
-        return None
+        return _query_chart_frame(*_canonical_filters(start_date, end_date, distrito, causa, nivel))
+    except Exception as e:
+        print(f"Error al ejecutar la query de filtro: {e}")
+    return _chart_frame(pd.DataFrame())
 
-def _day_range_local_to_utc(d):
-    start_local = TZ.localize(datetime.combine(d, time.min))
-    end_local   = TZ.localize(datetime.combine(d, time.max))
-    return start_local.astimezone(pytz.utc), end_local.astimezone(pytz.utc)
 
 def _as_date(x):
     """Devuelve un date a partir de date|datetime|None, sin reventar."""
@@ -159,18 +155,20 @@ def _as_date(x):
 
 
 
+# Los dos parsers son puros y reciben pocas cadenas distintas (una por día / hora con
+# incidencias) repetidas en cada fila: se memoizan por cadena.
+@lru_cache(maxsize=8192)
 def _parse_date_flexible(s):
     """Acepta DD-MM-YYYY o YYYY-MM-DD y devuelve datetime (sin TZ)."""
     if not s:
         return None
-    for fmt in ("%d-%m-%Y", "%Y-%m-%d"):
-        try:
-            return datetime.strptime(s, fmt)
-        except Exception:
-            pass
-    return None  # si no matchea ninguno
+    return _match_date(s, "-")  # None si no matchea ninguno
 
 
+# HH:MM[:SS], con campos de 1 o 2 dígitos como acepta strptime
+_TIME_RE = re.compile(r'(\d{1,2}):(\d{1,2})(?::(\d{1,2}))?\Z')
+
+@lru_cache(maxsize=65536)
 def _parse_datetime_flexible(date_str, time_str):
     """Combina una fecha (flexible) y una hora (HH:MM[:SS]) en datetime.
     Si no puede parsear, devuelve 1900-01-01 00:00:00 para no romper el sort.
@@ -178,141 +176,260 @@ def _parse_datetime_flexible(date_str, time_str):
     d = _parse_date_flexible(date_str)
     if d is None:
         return datetime(1900, 1, 1)
-    h = (time_str or "00:00:00").strip()
-    t = None
-    for tfmt in ("%H:%M:%S", "%H:%M"):
-        try:
-            t = datetime.strptime(h, tfmt).time()
-            break
-        except Exception:
-            pass
-    if t is None:
-        t = datetime.min.time()
-    return datetime.combine(d, t)
+    m = _TIME_RE.match((time_str or "00:00:00").strip())
+    if m is None:
+        return d
+    h, mi, sec = m.groups()
+    try:
+        return d.replace(hour=int(h), minute=int(mi), second=int(sec or 0))
+    except ValueError:
+        return d
+
+
+
+def _query_df(query_api, query):
+    """Ejecuta una query Flux y devuelve un único DataFrame (vacío si no hay filas).
+    El FluxCSV se parsea directo a DataFrame, sin FluxRecord ni dicts por fila."""
+    df = query_api.query_data_frame(query, org=INFLUXDB_ORG)
+    # El cliente puede devolver una lista de DataFrames (una por esquema de tabla)
+    if isinstance(df, list):
+        df = pd.concat(df, ignore_index=True) if df else pd.DataFrame()
+    return pd.DataFrame() if df is None else df
+
+
+# Con la caché vacía (arranque, expiración o tras una carga) los requests concurrentes
+# esperan a que el primero la complete en vez de lanzar todos la misma query. Un
+# acierto de caché dura microsegundos, así que serializarlos no cuesta nada.
+_filter_options_lock = threading.Lock()
+_available_dates_lock = threading.Lock()
+
+
+@cache.memoize(timeout=300)
+def _query_filter_options():
+    """Consulta distritos y causas a InfluxDB. Se cachea; los errores no.
+    Ambas listas viajan en un único request, separadas por el nombre del yield.
+    measurementTagValues acota el índice a la measurement de incidencias; el start
+    explícito hace falta porque por defecto sólo mira los últimos 30 días."""
+    query_api = get_query_api()
+
+    query = f"""
+        import \"influxdata/influxdb/schema\"
+        schema.measurementTagValues(bucket: \"{INFLUXDB_BUCKET}\", measurement: \"incidencia_electrica\", tag: \"distrito\", start: -5y)
+            |> sort()
+            |> yield(name: \"distritos\")
+        schema.measurementTagValues(bucket: \"{INFLUXDB_BUCKET}\", measurement: \"incidencia_electrica\", tag: \"descripcion_de_la_causa\", start: -5y)
+            |> filter(fn: (r) => r._value != \"\")
+            |> sort()
+            |> yield(name: \"causas\")
+    """
+    df = _query_df(query_api, query)
+    if df.empty:
+        return [], []
 
+    # Valores ya distintos y ordenados por InfluxDB; el yield viene en la columna "result"
+    values = df["_value"].tolist()
+    results = df["result"].tolist()
+    options = {"distritos": [], "causas": []}
+    for result, value in zip(results, values):
+        options[result].append(value)
+    return options["distritos"], options["causas"]
 
 
 def get_filter_options():
     """Obtiene distritos y causas desde tags indexados de InfluxDB."""
-    distritos, causas = [], []
     try:
-        query_api = influx_client.query_api()
-
-        q_distritos = f"""
-            import \"influxdata/influxdb/schema\"
-            schema.tagValues(bucket: \"{INFLUXDB_BUCKET}\", tag: \"distrito\", start: -5y)
-        """
-        q_causas = f"""
-            import \"influxdata/influxdb/schema\"
-            schema.tagValues(bucket: \"{INFLUXDB_BUCKET}\", tag: \"descripcion_de_la_causa\", start: -5y)
-        """
-
-        result_distritos = query_api.query(q_distritos, org=INFLUXDB_ORG)
-        result_causas = query_api.query(q_causas, org=INFLUXDB_ORG)
-
-        distritos = [row.values["_value"] for table in result_distritos for row in table.records]
-        causas = [row.values["_value"] for table in result_causas for row in table.records]
-
+        with _filter_options_lock:
+            return _query_filter_options()
     except Exception as e:
         print(f"Error obteniendo opciones de filtro: {e}")
-
-    return sorted(distritos), sorted(causas)
+    return [], []
+
+
+@cache.memoize(timeout=300)
+def _query_available_dates():
+    """Un registro por día con datos: el conteo diario se resuelve en InfluxDB.
+    aggregateWindow va antes de group() para que el storage lo resuelva por serie
+    (window-aggregate pushdown); después sólo se unen días repetidos entre series.
+    Las ventanas se corren al día local (TZ): un incidente a las 22:00 cae en su día
+    y no en el siguiente día UTC."""
+    query_api = get_query_api()
+    # America/Argentina/San_Luis es UTC-3 fijo: las 00:00 locales son las 03:00 UTC
+    offset_h = -int(TZ.utcoffset(datetime.now()).total_seconds() // 3600)
+    query = f'''
+        from(bucket: "{INFLUXDB_BUCKET}")
+            |> range(start: -5y)
+            |> filter(fn: (r) => r._measurement == "incidencia_electrica" and r._field == "indice")
+            |> aggregateWindow(every: 1d, offset: {offset_h}h, fn: count, createEmpty: false, timeSrc: "_start")
+            |> group()
+            |> keep(columns: ["_time"])
+            |> unique(column: "_time")
+            |> sort(columns: ["_time"])
+    '''
+    df = _query_df(query_api, query)
+    if df.empty:
+        return []
+    # Una sola tabla, sin repetidos y ordenada por _time: cada fila es un día distinto.
+    # _start de cada ventana son las 00:00 locales: pasado a hora local da el día
+    local_days = df["_time"] - pd.Timedelta(hours=offset_h)
+    return local_days.dt.strftime('%Y-%m-%d').tolist()
 
 
 def get_available_dates():
     """Obtiene fechas únicas ordenadas con datos en el bucket."""
-    dates = set()
     try:
-        query_api = influx_client.query_api()
-        query = f'''
-            from(bucket: "{INFLUXDB_BUCKET}")
-                |> range(start: -5y)
-                |> filter(fn: (r) => r._measurement == "incidencia_electrica")
-                |> keep(columns: ["_time"])
-        '''
-        result = query_api.query(query, org=INFLUXDB_ORG)
-        for table in result:
-            for record in table.records:
-                date_str = record.get_time().strftime('%Y-%m-%d')
-                dates.add(date_str)
+        with _available_dates_lock:
+            return _query_available_dates()
     except Exception as e:
         print(f"Error obteniendo fechas: {e}")
-    return sorted(dates)
+    return []
+
+
+def _date_options(iso_dates, from_date=None):
+    """Fechas 'YYYY-MM-DD' (ya únicas y ordenadas, ver _query_available_dates) en el
+    formato DD-MM-YYYY de los combos, desde from_date inclusive. Al estar ordenadas,
+    el corte se busca por bisección sobre el texto ISO, sin parsear ni recorrer todo."""
+    start = bisect_left(iso_dates, from_date.isoformat()) if from_date else 0
+    return [f'{d[8:10]}-{d[5:7]}-{d[:4]}' for d in iso_dates[start:]]
+
+
+def refresh_influx_caches():
+    """Invalida las consultas cacheadas y vuelve a llenar las del panel (filtros y
+    fechas). Se llama desde los trabajos en segundo plano al terminar una carga o
+    purga: así el próximo request de un usuario no paga la consulta en frío."""
+    invalidate_influx_caches()
+    get_filter_options()
+    get_available_dates()
+
+
+def invalidate_influx_caches():
+    """Descarta las consultas cacheadas tras una carga o purga del bucket."""
+    cache.delete_memoized(_query_filter_options)
+    cache.delete_memoized(_query_available_dates)
+    cache.delete_memoized(_query_filtered_incidents)
+    cache.delete_memoized(_query_chart_frame)
+
+
+def _flux_params_header(params):
+    """Cabecera `params = {...}` con literales Flux ya armados (strings vía flux_str)."""
+    return 'params = {' + ', '.join(f'{k}: {v}' for k, v in params.items()) + '}\n'
+
+
+# Texto fijo de la query de incidencias: los valores llegan en un registro `params`
+# declarado en una cabecera (ver _query_filtered_incidents), nunca interpolados en el
+# pipeline. Es la misma forma que usan las queries parametrizadas de InfluxDB Cloud
+# (query(..., params=...)), que InfluxDB OSS 2.x no soporta.
+# Los filtros por tag van antes del pivot, y sólo los que están activos: así el
+# storage los resuelve con el índice de series y sólo se pivotean las series que
+# coinciden. "indice" (número de fila de la carga) no lo muestra ninguna vista: se
+# descarta antes del pivot. group() une las series antes de ordenar: el resultado sale
+# en orden cronológico global (sort sólo ordena dentro de cada tabla).
+INCIDENTS_FLUX_HEAD = """
+from(bucket: params.bucket)
+    |> range(start: params.start, stop: params.stop)
+    |> filter(fn: (r) => r._measurement == "incidencia_electrica" and r._field != "indice")
+"""
+INCIDENTS_FLUX_TAG_FILTER = '    |> filter(fn: (r) => r.{tag} == params.{tag})\n'
+# Fields que usa _chart_frame (los tags vienen igual como columnas): /graficos y el
+# cruce con clima sólo pivotean estas series, no todas las de la tabla
+CHART_FIELDS = ('nises_involucrados', 'potencia_involucrada', 'fecha_fin', 'hora_fin', 'dur_min')
+CHART_FLUX_FIELD_FILTER = (
+    '    |> filter(fn: (r) => ' + ' or '.join(f'r._field == "{f}"' for f in CHART_FIELDS) + ')\n'
+)
+INCIDENTS_FLUX_TAIL = """    |> drop(columns: ["_start", "_stop", "_measurement"])
+    |> pivot(rowKey:["_time"], columnKey: ["_field"], valueColumn: "_value")
+    |> group()
+"""
+# Sólo la tabla y el XLS necesitan el orden; los gráficos agregan y el cruce con clima
+# ordena su propio resultado
+INCIDENTS_FLUX_SORT = '    |> sort(columns: ["_time"])\n'
+
+
+@lru_cache(maxsize=4096)
+def _local_midnight_utc_iso(d):
+    """00:00 local del día `d` como literal UTC para range() de Flux. Se cachea por
+    fecha: los mismos días se repiten en cada consulta."""
+    start_local = TZ.localize(datetime.combine(d, time(0, 0, 0)))
+    return start_local.astimezone(pytz.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+@cache.memoize(timeout=120)
+def _query_filtered_incidents(start_date, end_date, distrito, causa, nivel_tension, chart_fields=False):
+    """Ejecuta la query de incidencias con los filtros dados y devuelve un DataFrame.
+    Con chart_fields=True sólo trae los fields de CHART_FIELDS, sin ordenar."""
+    query_api = get_query_api()
+
+    # ---- Construcción de rango (local -03:00 → UTC) ----
+    if start_date:
+        # 00:00 local del día inicio → 00:00 local del día siguiente a "end_date"
+        # (stop exclusivo), en UTC
+        start = _local_midnight_utc_iso(start_date)
+        stop  = _local_midnight_utc_iso(end_date + timedelta(days=1))
+    else:
+        # Rango amplio por defecto (evita unbounded read)
+        start, stop = '-5y', 'now()'
+
+    params = {'bucket': flux_str(INFLUXDB_BUCKET), 'start': start, 'stop': stop}
+    tags = {'distrito': distrito, 'descripcion_de_la_causa': causa, 'nivel_tension': nivel_tension}
+    tag_filters = ''
+    for tag, value in tags.items():
+        if value:
+            params[tag] = flux_str(value)
+            tag_filters += INCIDENTS_FLUX_TAG_FILTER.format(tag=tag)
+    if chart_fields:
+        tag_filters += CHART_FLUX_FIELD_FILTER
+    query = _flux_params_header(params) + INCIDENTS_FLUX_HEAD + tag_filters + INCIDENTS_FLUX_TAIL
+    if not chart_fields:
+        query += INCIDENTS_FLUX_SORT
+
+    df = _query_df(query_api, query)
+    if df.empty:
+        return df
+    # result/table son anotaciones del FluxCSV: no se muestran y viajarían en cada
+    # fila cacheada y en cada dict de la tabla del panel
+    df = df.drop(columns=['result', 'table'], errors='ignore')
+
+    # Normalización para mostrar, por columna. Los fields ya vienen como texto
+    # DD-MM-YYYY / HH:MM:SS desde la carga: no hace falta strftime por fila.
+    for col in ('fecha_inicio', 'hora_inicio', 'fecha_fin', 'hora_fin'):
+        df[f'{col}_fmt'] = df[col].fillna('') if col in df.columns else ''
+    return df
+
+
+def _canonical_filters(start_date, end_date, distrito, causa, nivel_tension):
+    """Normaliza los filtros para que filtros equivalentes (p.ej. la tabla del panel y
+    su descarga XLS) compartan la misma entrada de caché."""
+    if start_date:
+        end_date = end_date or start_date  # si no hay "Hasta", usamos el mismo día
+    else:
+        end_date = None
+    distrito = (distrito or '').strip() or None
+    causa = (causa or '').strip() or None
+    if nivel_tension not in ("BT", "MT"):
+        nivel_tension = None
+    return start_date, end_date, distrito, causa, nivel_tension
+
 
+@cache.memoize(timeout=120)
+def _query_chart_frame(start_date, end_date, distrito, causa, nivel_tension):
+    """Incidencias normalizadas por _chart_frame para /graficos. Las APIs de la página
+    piden todas los mismos filtros: se normaliza una vez por combinación de filtros."""
+    return _chart_frame(_query_filtered_incidents(start_date, end_date, distrito, causa, nivel_tension, True))
 
-def get_filtered_incidents(start_date, end_date, distrito, causa, nivel_tension=None):
-    """Construye y ejecuta una query de Flux dinámica basada en los filtros."""
-    processed_incidents = []
+
+def get_filtered_incidents_df(start_date, end_date, distrito, causa, nivel_tension=None):
+    """Incidencias filtradas como DataFrame (ver _canonical_filters)."""
     try:
-        query_api = influx_client.query_api()
-        query_parts = [f'from(bucket: "{INFLUXDB_BUCKET}")']
-
-        # ---- Construcción de rango (local -03:00 → UTC) ----
-        if start_date:
-            effective_end = end_date or start_date  # si no hay "Hasta", usamos el mismo día
-            # 00:00 local del día inicio  → UTC
-            start_local = TZ.localize(datetime.combine(start_date, time(0, 0, 0)))
-            # 00:00 local del día siguiente a "effective_end" (stop exclusivo) → UTC
-            stop_local  = TZ.localize(datetime.combine(effective_end, time(0, 0, 0))) + timedelta(days=1)
-
-            start_utc = start_local.astimezone(pytz.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
-            stop_utc  = stop_local.astimezone(pytz.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
-
-            query_parts.append(f'|> range(start: {start_utc}, stop: {stop_utc})')
-        else:
-            # Rango amplio por defecto (evita unbounded read)
-            query_parts.append('|> range(start: -5y)')
-
-        # Medición y pivot (igual que ahora)
-        query_parts += [
-            '|> filter(fn: (r) => r._measurement == "incidencia_electrica")',
-            '|> pivot(rowKey:["_time"], columnKey: ["_field"], valueColumn: "_value")'
-        ]
-
-        # Filtros existentes
-        if distrito:
-            query_parts.append(f'|> filter(fn: (r) => r.distrito == "{distrito}")')
-        if causa:
-            causa_escaped = causa.replace('\\', '\\\\').replace('"', '\\"')
-            query_parts.append(f'|> filter(fn: (r) => r.descripcion_de_la_causa == "{causa_escaped}")')
-
-        # 🆕 Filtro de nivel de tensión
-        if nivel_tension in ("BT", "MT"):
-            query_parts.append(f'|> filter(fn: (r) => r.nivel_tension == "{nivel_tension}")')
-
-        query_parts.append('|> sort(columns: ["_time"], desc: true)')
-        query = "\n".join(query_parts)
-
-        tables = query_api.query(query, org=INFLUXDB_ORG)
-        incidents_data = [record.values for table in tables for record in table.records]
-        for incident in incidents_data:
-            # Normalización para mostrar (tu lógica actual)
-            incident['fecha_inicio_fmt'] = incident.get('fecha_inicio', '')
-            incident['hora_inicio_fmt']  = incident.get('hora_inicio', '')
-            incident['fecha_fin_fmt']    = incident.get('fecha_fin', '')
-            incident['hora_fin_fmt']     = incident.get('hora_fin', '')
-            processed_incidents.append(incident)
+        return _query_filtered_incidents(*_canonical_filters(start_date, end_date, distrito, causa, nivel_tension))
     except Exception as e:
         print(f"Error al ejecutar la query de filtro: {e}")
-    return processed_incidents
+    return pd.DataFrame()
+
 
-def compute_total_duration(incidents):
-    """Suma el tiempo (fin - inicio) de cada incidente.
+def compute_total_duration(df):
+    """Suma el tiempo (fin - inicio) de cada incidente del DataFrame filtrado.
     Devuelve (string_legible, total_minutos)."""
-    total = timedelta(0)
-    for inc in incidents:
-        # Usamos *_fmt si existen; si no, tomamos los originales
-        f_ini = inc.get('fecha_inicio_fmt') or inc.get('fecha_inicio')
-        h_ini = inc.get('hora_inicio_fmt')  or inc.get('hora_inicio')
-        f_fin = inc.get('fecha_fin_fmt')    or inc.get('fecha_fin')
-        h_fin = inc.get('hora_fin_fmt')     or inc.get('hora_fin')
-
-        sd = _parse_datetime_flexible(f_ini, h_ini)
-        ed = _parse_datetime_flexible(f_fin, h_fin)
-        if ed >= sd:
-            total += (ed - sd)
-
-    total_seconds = int(total.total_seconds())
+    # _chart_frame ya calcula la duración por columnas y descarta las negativas
+    total_seconds = int(round(float(_chart_frame(df)['dur_min'].sum()) * 60))
     minutes = (total_seconds // 60) % 60
     hours   = (total_seconds // 3600) % 24
     days    =  total_seconds // (24 * 3600)
@@ -327,38 +444,58 @@ def compute_total_duration(incidents):
 
     return " ".join(parts), (total_seconds // 60)
 
+def _json_response(payload):
+    """Respuesta JSON serializada con orjson (bytes directos, sin str intermedio).
+    Para las listas largas de fechas / distritos / causas y las series de /graficos."""
+    return Response(orjson.dumps(payload), mimetype='application/json')
+
 @main.route("/api/end_dates")
 @login_required
 def api_end_dates():
     frm = (request.args.get("from") or "").strip()
     d_from_dt = _parse_date_flexible(frm)
     if d_from_dt is None:
-        return jsonify({"dates": []})
+        return _json_response({"dates": []})
     d_from = d_from_dt.date()
 
-    raw_all = get_available_dates()  # strings en distintos formatos
-    all_dt = sorted({
-        (_parse_date_flexible(d).date())
-        for d in raw_all
-        if _parse_date_flexible(d) is not None
-    })
-    end_dates = [d.strftime("%d-%m-%Y") for d in all_dt if d >= d_from]
-    return jsonify({"dates": end_dates})
-
+    return _json_response({"dates": _date_options(get_available_dates(), d_from)})
+
+
+# La consulta de incidencias filtradas (la única que suele no estar en caché) corre en
+# este pool mientras el hilo del request resuelve los filtros y las fechas, que casi
+# siempre salen de la caché. Es I/O de red (suelta el GIL): la latencia es la de la más
+# lenta en lugar de la suma. Cada request ocupa a lo sumo un hilo y el pool es por
+# proceso: 4 cubre un worker sync (1 request a la vez) o gthread con hasta --threads 4;
+# con más hilos por worker las consultas sobrantes esperan turno (subir este valor).
+_index_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='index-query')
+
+def _with_app_context(app, fn, *args):
+    # El caché (Flask-Caching) necesita el contexto de la aplicación en cada hilo
+    with app.app_context():
+        return fn(*args)
+
+def _fetch_index_data(filter_args=None, filter_options=True):
+    """Devuelve (distritos, causas, fechas disponibles, incidencias filtradas o None).
+    Con filter_options=False no consulta distritos ni causas (vienen vacíos)."""
+    f_incidents = None
+    if filter_args is not None:
+        app = current_app._get_current_object()
+        f_incidents = _index_pool.submit(_with_app_context, app, get_filtered_incidents_df, *filter_args)
+    distritos, causas = get_filter_options() if filter_options else ([], [])
+    dates = get_available_dates()
+    return distritos, causas, dates, f_incidents.result() if f_incidents else None
 
 @main.route('/', methods=['GET', 'POST'])
 @login_required
 def index():
-    distritos, causas = get_filter_options()
     incidents = []
     form_data = {}
 
-    # Fechas disponibles (siempre cargar "Desde")
-    raw_all_dates = get_available_dates()
-    all_dt = sorted({(_parse_date_flexible(d).date()) for d in raw_all_dates if _parse_date_flexible(d) is not None})
-    available_start_dates = [dt.strftime("%d-%m-%Y") for dt in all_dt]
-
     if request.method == 'GET':
+        # Los combos de distrito y causa los completa la página con /filtros_opciones:
+        # el primer render no espera esas dos consultas
+        distritos, causas, raw_all_dates, _ = _fetch_index_data(filter_options=False)
+        available_start_dates = _date_options(raw_all_dates)
         return render_template(
             'index.html',
             name=current_user.name,
@@ -373,10 +510,8 @@ def index():
         )
 
     # POST
-    sd = _parse_date_flexible(request.form.get('start_date'))
-    ed = _parse_date_flexible(request.form.get('end_date'))
-    start_date = sd.date() if sd else None
-    end_date   = ed.date() if ed else None
+    start_date = _as_date(_parse_date_flexible(request.form.get('start_date')))
+    end_date   = _as_date(_parse_date_flexible(request.form.get('end_date')))
 
     distrito       = (request.form.get('distrito') or '').strip() or None
     causa          = (request.form.get('causa') or '').strip() or None
@@ -396,38 +531,18 @@ def index():
         'graficar': graficar,
     })
 
-    # Validaciones de fechas (misma lógica que tenías)
+    # Validaciones de fechas y exclusividad de checkboxes
+    error = None
     if end_date and not start_date:
-        flash("Seleccione primero la fecha 'Desde'.", "warning")
-        return render_template('index.html', name=current_user.name, distritos=distritos, causas=causas,
-                               form_data=form_data, incidents=[],
-                               available_start_dates=available_start_dates,
-                               available_end_dates=[],
-                               total_duration_str=None, total_duration_minutes=None)
-
-    if start_date and end_date and end_date < start_date:
-        flash("La fecha 'Hasta' no puede ser anterior a 'Desde'.", "warning")
-        available_end_dates = [d.strftime("%d-%m-%Y") for d in all_dt if d >= start_date]
-        return render_template('index.html', name=current_user.name, distritos=distritos, causas=causas,
-                               form_data=form_data, incidents=[],
-                               available_start_dates=available_start_dates,
-                               available_end_dates=available_end_dates,
-                               total_duration_str=None, total_duration_minutes=None)
-
-    # Armar "Hasta" a partir de "Desde"
-    available_end_dates = [d.strftime("%d-%m-%Y") for d in all_dt if (not start_date or d >= start_date)]
-
-    # Exclusividad de checkboxes
-    if traer_tabla and graficar:
-        flash("No se pueden seleccionar 'Traer tabla' y 'Graficar' al mismo tiempo.", "warning")
-        return render_template('index.html', name=current_user.name, distritos=distritos, causas=causas,
-                               form_data=form_data, incidents=[],
-                               available_start_dates=available_start_dates,
-                               available_end_dates=available_end_dates,
-                               total_duration_str=None, total_duration_minutes=None)
-
-    # Si el usuario eligió 'Graficar' -> ir a la página de gráficos con los filtros como querystring
-    if graficar:
+        error = "Seleccione primero la fecha 'Desde'."
+    elif start_date and end_date and end_date < start_date:
+        error = "La fecha 'Hasta' no puede ser anterior a 'Desde'."
+    elif traer_tabla and graficar:
+        error = "No se pueden seleccionar 'Traer tabla' y 'Graficar' al mismo tiempo."
+
+    # Si el usuario eligió 'Graficar' -> ir a la página de gráficos con los filtros como
+    # querystring (no hace falta consultar nada para este request)
+    if graficar and not error:
         params = {
             'start_date': form_data['start_date'],
             'end_date':   form_data['end_date'],
@@ -437,24 +552,33 @@ def index():
         }
         return redirect(url_for('main.graficos', **params))
 
-    # Caso "Traer tabla" (o ninguno marcado: por defecto tabla)
-    if (not start_date and not end_date) and (distrito or causa or nivel_tension):
-        incidents = get_filtered_incidents(None, None, distrito, causa, nivel_tension)
-    elif start_date:
-        effective_end = end_date or start_date
-        incidents = get_filtered_incidents(start_date, effective_end, distrito, causa, nivel_tension)
-    else:
-        incidents = []
+    # Caso "Traer tabla" (o ninguno marcado: por defecto tabla). Si el formulario es
+    # válido la tabla se consulta en paralelo con los filtros y las fechas disponibles
+    filter_args = None
+    if not error:
+        if (not start_date and not end_date) and (distrito or causa or nivel_tension):
+            filter_args = (None, None, distrito, causa, nivel_tension)
+        elif start_date:
+            filter_args = (start_date, end_date or start_date, distrito, causa, nivel_tension)
 
-    # Orden cronológico robusto
-    incidents.sort(key=lambda inc: _parse_datetime_flexible(
-        inc.get('fecha_inicio_fmt', '01-01-1900'), inc.get('hora_inicio_fmt', '00:00:00')
-    ))
+    distritos, causas, raw_all_dates, filtered = _fetch_index_data(filter_args)
+    available_start_dates = _date_options(raw_all_dates)
+
+    # Armar "Hasta" a partir de "Desde"
+    if end_date and not start_date:
+        available_end_dates = []
+    else:
+        available_end_dates = _date_options(raw_all_dates, start_date)
 
-    # Resumen de tiempos acumulados
+    # Ya vienen en orden cronológico (_time = inicio del incidente) desde InfluxDB.
+    # El resumen se calcula sobre el DataFrame; la tabla (Jinja) usa la lista de dicts
     total_duration_str, total_duration_minutes = (None, None)
-    if incidents:
-        total_duration_str, total_duration_minutes = compute_total_duration(incidents)
+    if error:
+        flash(error, "warning")
+    elif filtered is not None and not filtered.empty:
+        # Los campos ausentes se muestran vacíos, como cuando la clave no existía
+        incidents = filtered.fillna('').to_dict('records')
+        total_duration_str, total_duration_minutes = compute_total_duration(filtered)
 
     return render_template(
         'index.html',
@@ -473,7 +597,16 @@ def index():
 @login_required
 def upload_page():
     """Muestra la página dedicada a la carga de archivos."""
-    return render_template('upload.html', name=current_user.name)
+    return render_template('upload.html', name=current_user.name, job_id=request.args.get('job'))
+
+@main.route('/upload/status/<job_id>')
+@login_required
+def upload_status(job_id):
+    """Estado de un archivo encolado por /upload."""
+    status = get_job_status(current_app.config['UPLOAD_FOLDER'], job_id)
+    if status is None:
+        return jsonify({'status': 'desconocido'}), 404
+    return jsonify({'status': status})
 
 @main.route('/upload', methods=['POST'])
 @login_required
@@ -485,68 +618,117 @@ def upload_file():
     if file.filename == '':
         flash('No se seleccionó ningún archivo.')
         return redirect(url_for('main.upload_page'))
-    allowed_extensions = ('.csv', '.xls', '.xlsx')
+    # Sólo CSV: es lo único que procesa services.process_file_to_influxdb (rechazarlo
+    # acá evita encolar un trabajo que igual fallaría)
+    allowed_extensions = ('.csv',)
     if file and file.filename.lower().endswith(allowed_extensions):
+        upload_folder = current_app.config['UPLOAD_FOLDER']
+        job_id = reserve_upload(upload_folder)
+        if job_id is None:
+            flash('Hay demasiados archivos procesándose o una purga en curso. Intente de nuevo en unos minutos.', 'warning')
+            return redirect(url_for('main.upload_page'))
         original_filename = file.filename
         name, extension = os.path.splitext(original_filename)
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         new_filename = f"{name}_{timestamp}{extension}"
-        filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], new_filename)
-        file.save(filepath)
-        process_file_to_influxdb(filepath)
-        flash(f"Archivo '{original_filename}' procesado exitosamente.", "success")
-        return redirect(url_for('main.upload_page'))
-    flash('Formato de archivo no válido. Por favor, sube un archivo CSV o Excel.', 'error')
+        filepath = os.path.join(upload_folder, new_filename)
+        try:
+            file.save(filepath)
+        except Exception:
+            release_job(upload_folder, job_id)
+            raise
+
+        app = current_app._get_current_object()
+
+        def on_done():
+            # La caché vive en la app: el worker necesita su propio contexto
+            with app.app_context():
+                refresh_influx_caches()
+
+        submit_file_processing(filepath, job_id, on_done=on_done)
+        flash(f"Archivo '{original_filename}' recibido. Se está procesando en segundo plano.", "success")
+        return redirect(url_for('main.upload_page', job=job_id))
+    flash('Formato de archivo no válido. Por favor, sube un archivo CSV.', 'error')
     return redirect(url_for('main.upload_page'))
 
+# (encabezado en el XLS, columna de origen en la query de incidencias)
+XLS_COLUMNS = (
+    ('Nro. Incidencia', 'nro_incidencia'),
+    ('Fecha de Inicio', 'fecha_inicio_fmt'),
+    ('Hora de Inicio', 'hora_inicio_fmt'),
+    ('Fecha de Fin', 'fecha_fin_fmt'),
+    ('Hora de Fin', 'hora_fin_fmt'),
+    ('Distrito', 'distrito'),
+    ('Nivel de Tensión', 'nivel_tension'),
+    ('Instalación', 'instalacion'),
+    ('Localidad', 'localidad'),
+    ('Distribuidor', 'distribuidor'),
+    ('Causa', 'descripcion_de_la_causa'),
+    ('Reclamos', 'cantidad_de_reclamos'),
+    ('CT Involucrados', 'ct_involucrados'),
+    ('Clientes Afectados', 'nises_involucrados'),
+    ('Potencia Involucrada', 'potencia_involucrada'),
+)
+XLS_HEADERS = [header for header, _ in XLS_COLUMNS]
+XLS_SOURCE_KEYS = [key for _, key in XLS_COLUMNS]
+
+EXPORT_MAX_AGE_S = 600  # los XLS generados se borran pasados 10 minutos
+
+def _prune_old_exports(folder):
+    """Borra exportaciones viejas. No se borran al responder porque con X-Sendfile
+    el servidor web lee el archivo después de que la vista terminó."""
+    limit = datetime.now().timestamp() - EXPORT_MAX_AGE_S
+    for entry in os.scandir(folder):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < limit:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
 @main.route('/download_xls')
 @login_required
 def download_xls():
     # _parse_date_flexible devuelve datetime; lo pasamos a date para ser coherentes
-    start_dt = _parse_date_flexible(request.args.get('start_date'))
-    end_dt   = _parse_date_flexible(request.args.get('end_date'))
-    start_date = start_dt.date() if start_dt else None
-    end_date   = end_dt.date()   if end_dt   else None
+    start_date = _as_date(_parse_date_flexible(request.args.get('start_date')))
+    end_date   = _as_date(_parse_date_flexible(request.args.get('end_date')))
     distrito = request.args.get('distrito')
     causa = request.args.get('causa')
     nivel_tension = request.args.get('nivel_tension')
 
-    incidents = get_filtered_incidents(start_date, end_date, distrito, causa, nivel_tension)
+    df = get_filtered_incidents_df(start_date, end_date, distrito, causa, nivel_tension)
 
-    if not incidents:
+    if df.empty:
         return "No hay datos para descargar con los filtros seleccionados.", 404
 
-    df = pd.DataFrame(incidents)
-
-    df_export = pd.DataFrame({
-        'Nro. Incidencia': df.get('nro_incidencia', ''),
-        'Fecha de Inicio': df.get('fecha_inicio_fmt', ''),
-        'Hora de Inicio': df.get('hora_inicio_fmt', ''),
-        'Fecha de Fin': df.get('fecha_fin_fmt', ''),
-        'Hora de Fin': df.get('hora_fin_fmt', ''),
-        'Distrito': df.get('distrito', ''),
-        'Nivel de Tensión': df.get('nivel_tension', ''),
-        'Instalación': df.get('instalacion', ''),
-        'Localidad': df.get('localidad', ''),
-        'Distribuidor': df.get('distribuidor', ''),
-        'Causa': df.get('descripcion_de_la_causa', ''),
-        'Reclamos': df.get('cantidad_de_reclamos', ''),
-        'CT Involucrados': df.get('ct_involucrados', ''),
-        'Clientes Afectados': df.get('nises_involucrados', ''),
-        'Potencia Involucrada': df.get('potencia_involucrada', '')
-    })
-
-    output = io.BytesIO()
-    writer = pd.ExcelWriter(output, engine='xlsxwriter')
-    df_export.to_excel(writer, index=False, sheet_name='Incidencias')
-    writer.close()
-    output.seek(0)
+    # Sólo las columnas exportadas, en orden y en un único reindex (las que falten
+    # quedan NaN); NaN → None para que xlsxwriter deje la celda vacía
+    export = df.reindex(columns=XLS_SOURCE_KEYS).astype(object)
+    export = export.where(export.notna(), None)
+
+    # El libro se escribe a un archivo en disco (no a memoria) para que send_file pueda
+    # delegar la transferencia al servidor web con X-Sendfile (USE_X_SENDFILE).
+    export_dir = current_app.config['EXPORT_FOLDER']
+    _prune_old_exports(export_dir)
+    fd, output_path = tempfile.mkstemp(prefix='reporte_', suffix='.xlsx', dir=export_dir)
+    os.close(fd)
+
+    # constant_memory: xlsxwriter vuelca cada fila a disco al pasar a la siguiente en vez
+    # de retener la hoja entera. Exige escribir fila por fila (to_excel escribe por
+    # columna y perdería datos), por eso se escribe directo con xlsxwriter.
+    workbook = xlsxwriter.Workbook(output_path, {'constant_memory': True})
+    sheet = workbook.add_worksheet('Incidencias')
+    sheet.write_row(0, 0, XLS_HEADERS, workbook.add_format({'bold': True, 'border': 1}))
+    # Las filas se generan de a una (itertuples), sin materializar una lista con todas
+    for row_idx, row in enumerate(export.itertuples(index=False, name=None), 1):
+        sheet.write_row(row_idx, 0, row)
+    workbook.close()
 
     return send_file(
-        output,
+        output_path,
         mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
         as_attachment=True,
-        download_name='reporte_incidencias.xlsx'
+        download_name='reporte_incidencias.xlsx',
+        conditional=True,
     )
 
 @main.route('/filtros_opciones', methods=['GET'])
@@ -557,7 +739,7 @@ def filtros_opciones():
     except Exception:
         distritos, causas = [], []
     # Nivel de tensión lo acotamos a las dos opciones pedidas
-    return jsonify({
+    return _json_response({
         'distritos': distritos,
         'causas': causas,
         'nivel_tension': ['BT', 'MT']
@@ -576,111 +758,54 @@ def graficos():
     }
     return render_template('graficos.html', name=current_user.name, form_data=form_data)
 
-@main.route('/api/graficos/kpis', methods=['GET'])
-@login_required
-def api_kpis():
-    rows = _fetch_incidents_with_filters()
-    total_inc = len(rows)
-    total_min = sum(r['dur_min'] for r in rows)
-    clientes_min = sum(r['nises'] * r['dur_min'] for r in rows)
-    potencia_total = sum(r['potencia'] for r in rows)
-
-    return jsonify({
-        'incidencias': total_inc,
-        'total_minutos': round(total_min, 2),
-        'clientes_min': round(clientes_min, 2),
-        'potencia_total_kw': round(potencia_total, 2)
-    })
+def _kpis(df):
+    return {
+        'incidencias': len(df),
+        'total_minutos': round(float(df['dur_min'].sum()), 2),
+        'clientes_min': round(float((df['nises'] * df['dur_min']).sum()), 2),
+        'potencia_total_kw': round(float(df['potencia'].sum()), 2)
+    }
 
-@main.route('/api/graficos/serie_incidencias', methods=['GET'])
-@login_required
-def api_serie_incidencias():
-    rows = _fetch_incidents_with_filters()
-    # Conjunto de días presentes
-    dias = set()
-    for r in rows:
-        dias.add(r['dt_inicio_local'].date())
-    if not dias:
-        return jsonify({'dates': [], 'total': [], 'BT': [], 'MT': []})
-
-    dates_sorted = sorted(dias)
-    idx = {d: i for i, d in enumerate(dates_sorted)}
-    total = [0]*len(dates_sorted)
-    bt    = [0]*len(dates_sorted)
-    mt    = [0]*len(dates_sorted)
-
-    for r in rows:
-        i = idx[r['dt_inicio_local'].date()]
-        total[i] += 1
-        nv = (r['nivel_tension'] or '').upper()
-        if nv == 'BT':
-            bt[i] += 1
-        elif nv == 'MT':
-            mt[i] += 1
-
-    return jsonify({
-        'dates': [d.strftime('%Y-%m-%d') for d in dates_sorted],
-        'total': total,
-        'BT': bt,
-        'MT': mt,
+def _by_day_and_level(df, values):
+    """Suma `values` por día local (en orden) para el total, BT y MT."""
+    code = df['nivel_code']
+    frame = pd.DataFrame({
+        'day': df['dt_inicio_local'].dt.normalize(),
+        'total': values,
+        'BT': values.where(code == NIVEL_BT, 0),
+        'MT': values.where(code == NIVEL_MT, 0),
     })
+    return frame.groupby('day', sort=True).sum()
+
+def _serie(per_day):
+    return {
+        'dates': per_day.index.strftime('%Y-%m-%d').tolist(),
+        'total': per_day['total'].tolist(),
+        'BT': per_day['BT'].tolist(),
+        'MT': per_day['MT'].tolist(),
+    }
 
+def _serie_incidencias(df):
+    return _serie(_by_day_and_level(df, pd.Series(1, index=df.index)))
 
-@main.route('/api/graficos/serie_duracion', methods=['GET'])
-@login_required
-def api_serie_duracion():
-    rows = _fetch_incidents_with_filters()
-    dias = set(r['dt_inicio_local'].date() for r in rows)
-    if not dias:
-        return jsonify({'dates': [], 'total': [], 'BT': [], 'MT': []})
-
-    dates_sorted = sorted(dias)
-    idx = {d: i for i, d in enumerate(dates_sorted)}
-    total = [0.0]*len(dates_sorted)
-    bt    = [0.0]*len(dates_sorted)
-    mt    = [0.0]*len(dates_sorted)
-
-    for r in rows:
-        i = idx[r['dt_inicio_local'].date()]
-        total[i] += r['dur_min']
-        nv = (r['nivel_tension'] or '').upper()
-        if nv == 'BT':
-            bt[i] += r['dur_min']
-        elif nv == 'MT':
-            mt[i] += r['dur_min']
-
-    return jsonify({
-        'dates': [d.strftime('%Y-%m-%d') for d in dates_sorted],
-        'total': [round(x,2) for x in total],
-        'BT': [round(x,2) for x in bt],
-        'MT': [round(x,2) for x in mt],
-    })
+def _serie_duracion(df):
+    return _serie(_by_day_and_level(df, df['dur_min']).round(2))
 
-@main.route('/api/graficos/pareto_causas', methods=['GET'])
-@login_required
-def api_pareto_causas():
-    metric = (request.args.get('metric') or 'incidencias').lower()
-    rows = _fetch_incidents_with_filters()
-
-    agg = defaultdict(float)
-    for r in rows:
-        key = r['causa']
-        if metric == 'minutos':
-            agg[key] += r['dur_min']
-        else:
-            agg[key] += 1.0
-
-    # Orden descendente y top N (p.ej., top 12) + "Otros"
-    items = sorted(agg.items(), key=lambda kv: kv[1], reverse=True)
-    TOPN = 12
-    top = items[:TOPN]
-    rest = items[TOPN:]
-    if rest:
-        otros_val = sum(v for _, v in rest)
-        top.append(('Otros', otros_val))
+def _pareto_causas(df, metric):
+    values = df['dur_min'] if metric == 'minutos' else pd.Series(1.0, index=df.index)
+    # Agrupado por nombre de causa: a igual valor desempata el nombre (las filas no
+    # vienen ordenadas, así que el orden de aparición no sería reproducible)
+    agg = values.groupby(df['causa'], sort=True).sum()
 
-    categories = [k for k,_ in top]
-    values = [round(v,2) for _,v in top]
+    # Top N (p.ej., top 12) + "Otros". nlargest selecciona sin ordenar todas las causas;
+    # "Otros" es el total menos el top, sin otra pasada por el resto
+    TOPN = 12
+    top = agg.nlargest(TOPN, keep='first')
+    categories = top.index.tolist()
+    values = [round(v, 2) for v in top.tolist()]
+    if len(agg) > TOPN:
+        categories.append('Otros')
+        values.append(round(float(agg.sum() - top.sum()), 2))
 
     # Cálculo de acumulada (%)
     total = sum(values) or 1.0
@@ -690,53 +815,103 @@ def api_pareto_causas():
         run += v
         acumulada.append(round(100.0*run/total, 2))
 
-    return jsonify({
+    return {
         'categories': categories,
         'values': values,
         'acumulada_pct': acumulada
-    })
-
-@main.route('/api/graficos/heatmap_horadia', methods=['GET'])
-@login_required
-def api_heatmap_horadia():
-    """Mapa de calor hora (0–23) × día de semana (Lun–Dom).
-    Parámetro opcional: metric=incidencias|minutos (default: minutos)
-    """
-    metric = (request.args.get('metric') or 'minutos').lower()
-    rows = _fetch_incidents_with_filters()
+    }
 
+def _heatmap_horadia(df, metric):
     # Ejes
     horas = list(range(24))
     week_labels = ['Lun','Mar','Mié','Jue','Vie','Sáb','Dom']  # Monday=0
 
-    # Matriz 7x24 inicializada en 0
-    mat = [[0.0 for _ in horas] for _ in range(7)]
-
-    for r in rows:
-        dow = r['dt_inicio_local'].weekday()  # 0=Lun ... 6=Dom
-        h   = r['dt_inicio_local'].hour
-        if metric == 'incidencias':
-            mat[dow][h] += 1.0
-        else:
-            mat[dow][h] += r['dur_min']
+    # Matriz 7x24 (día de semana × hora), aplanada por filas; 0 donde no hay datos
+    values = pd.Series(1.0, index=df.index) if metric == 'incidencias' else df['dur_min']
+    start = df['dt_inicio_local']
+    mat = values.groupby([start.dt.weekday, start.dt.hour]).sum()
+    mat = mat.reindex(pd.MultiIndex.from_product([range(7), horas]), fill_value=0.0)
+    flat = mat.round(2).tolist()
 
     # Convertimos a tripletas [x(hour), y(dow), value]
-    data = []
-    vmax = 0.0
-    for y in range(7):
-        for x in horas:
-            v = round(mat[y][x], 2)
-            vmax = max(vmax, v)
-            data.append([x, y, v])
-
-    return jsonify({
+    data = [[x, y, flat[y * 24 + x]] for y in range(7) for x in horas]
+
+    return {
         'hours': horas,
         'weekdays': week_labels,
         'data': data,
-        'max': round(vmax, 2),
+        'max': max(flat),
         'metric': metric
+    }
+
+# Bins del histograma de duración: [desde, hasta) en minutos, cortes internos
+HISTO_EDGES = [15, 60, 120, 240]
+HISTO_LABELS = ['<15', '15–60', '1–2h', '2–4h', '>4h']
+
+def _histo_duracion(df):
+    # Índice de bin por fila con una búsqueda binaria vectorizada; bincount cuenta por bin
+    bins = np.searchsorted(HISTO_EDGES, df['dur_min'].to_numpy(), side='right')
+    code = df['nivel_code'].to_numpy()
+
+    def counts(mask=None):
+        b = bins if mask is None else bins[mask]
+        return np.bincount(b, minlength=len(HISTO_LABELS)).tolist()
+
+    return {
+        'categories': HISTO_LABELS,
+        'total': counts(),
+        'BT': counts(code == NIVEL_BT),
+        'MT': counts(code == NIVEL_MT)
+    }
+
+@main.route('/api/graficos/bundle', methods=['GET'])
+@login_required
+def api_graficos_bundle():
+    """Todos los gráficos de /graficos en una sola respuesta, sobre una única consulta.
+    Parámetro opcional: heatmap_metric=incidencias|minutos (default: minutos)
+    """
+    df = _fetch_incidents_with_filters()
+    return _json_response({
+        'kpis': _kpis(df),
+        'serie_incidencias': _serie_incidencias(df),
+        'serie_duracion': _serie_duracion(df),
+        'pareto_incidencias': _pareto_causas(df, 'incidencias'),
+        'pareto_minutos': _pareto_causas(df, 'minutos'),
+        'heatmap_horadia': _heatmap_horadia(df, (request.args.get('heatmap_metric') or 'minutos').lower()),
+        'histo_duracion': _histo_duracion(df),
     })
 
+@main.route('/api/graficos/kpis', methods=['GET'])
+@login_required
+def api_kpis():
+    return _json_response(_kpis(_fetch_incidents_with_filters()))
+
+@main.route('/api/graficos/serie_incidencias', methods=['GET'])
+@login_required
+def api_serie_incidencias():
+    return _json_response(_serie_incidencias(_fetch_incidents_with_filters()))
+
+
+@main.route('/api/graficos/serie_duracion', methods=['GET'])
+@login_required
+def api_serie_duracion():
+    return _json_response(_serie_duracion(_fetch_incidents_with_filters()))
+
+@main.route('/api/graficos/pareto_causas', methods=['GET'])
+@login_required
+def api_pareto_causas():
+    metric = (request.args.get('metric') or 'incidencias').lower()
+    return _json_response(_pareto_causas(_fetch_incidents_with_filters(), metric))
+
+@main.route('/api/graficos/heatmap_horadia', methods=['GET'])
+@login_required
+def api_heatmap_horadia():
+    """Mapa de calor hora (0–23) × día de semana (Lun–Dom).
+    Parámetro opcional: metric=incidencias|minutos (default: minutos)
+    """
+    metric = (request.args.get('metric') or 'minutos').lower()
+    return _json_response(_heatmap_horadia(_fetch_incidents_with_filters(), metric))
+
 @main.route('/api/graficos/histo_duracion', methods=['GET'])
 @login_required
 def api_histo_duracion():
@@ -744,48 +919,12 @@ def api_histo_duracion():
     Bins: <15, 15–60, 60–120, 120–240, >240.
     Devuelve series Total, BT y MT (barras apiladas).
     """
-    rows = _fetch_incidents_with_filters()
-
-    bins = [
-        ('<15',    lambda m: m < 15),
-        ('15–60',  lambda m: 15 <= m < 60),
-        ('1–2h',   lambda m: 60 <= m < 120),
-        ('2–4h',   lambda m: 120 <= m < 240),
-        ('>4h',    lambda m: m >= 240),
-    ]
-
-    cats = [b[0] for b in bins]
-    tot = [0]*len(bins)
-    bt  = [0]*len(bins)
-    mt  = [0]*len(bins)
-
-    def bin_index(m):
-        for i, (_, cond) in enumerate(bins):
-            if cond(m):
-                return i
-        return len(bins)-1
-
-    for r in rows:
-        i = bin_index(r['dur_min'])
-        tot[i] += 1
-        nv = (r['nivel_tension'] or '').upper()
-        if nv == 'BT':
-            bt[i] += 1
-        elif nv == 'MT':
-            mt[i] += 1
-
-    return jsonify({
-        'categories': cats,
-        'total': tot,
-        'BT': bt,
-        'MT': mt
-    })
+    return _json_response(_histo_duracion(_fetch_incidents_with_filters()))
 
 @main.route('/comparar_clima', methods=['GET', 'POST'])
 @login_required
 def comparar_clima():
-    distritos, _ = get_filter_options()
-    available_start_dates = get_available_dates()
+    distritos, _, available_start_dates, _ = _fetch_index_data()
 
     form_data = {
         'start_date': request.values.get('start_date', '').strip(),
@@ -795,7 +934,7 @@ def comparar_clima():
     }
 
     sd = _parse_date_or_none(form_data['start_date'])
-    available_end_dates = _build_available_end_dates(sd) if sd else []
+    available_end_dates = _build_available_end_dates(sd, available_start_dates) if sd else []
 
     # GET inicial (sin start_date): solo muestra filtros
     if request.method == 'GET' and not request.args.get('start_date'):
@@ -828,15 +967,19 @@ def comparar_clima():
     print(f"[comparar_clima] filtros sd={effective_start} ed={effective_end} dist={distrito or 'Todos'} nt={nivel_tension or 'Todos'}")
 
     # 1) Traer incidencias
-    base_incidents = get_filtered_incidents(effective_start, effective_end, distrito, None, nivel_tension)
-    norm = list(_incident_iter(base_incidents))
+    # Mismas filas normalizadas (y misma caché) que los gráficos
+    try:
+        norm = _query_chart_frame(*_canonical_filters(effective_start, effective_end, distrito, None, nivel_tension))
+    except Exception as e:
+        print(f"Error al ejecutar la query de filtro: {e}")
+        norm = pd.DataFrame()
     print(f"[comparar_clima] incidencias normalizadas = {len(norm)}")
-    if norm[:1]:
+    if not norm.empty:
         # dump de ejemplo para ver las claves
-        sample = {k: (str(v)[:19] if 'dt_' in k else v) for k,v in norm[0].items()}
+        sample = {k: (str(v)[:19] if 'dt_' in k else v) for k,v in norm.iloc[0].items()}
         print(f"[comparar_clima] ejemplo incidencia -> {sample}")
 
-    if not norm:
+    if norm.empty:
         # Sin incidencias: devolver DF vacío (la vista muestra el banner azul)
         return render_template('comparar_clima.html',
             name=current_user.name,
@@ -859,7 +1002,7 @@ def comparar_clima():
 
     # 3) Clima y cruce
     try:
-        w_query_api = weather_influx_client.query_api()
+        w_query_api = get_weather_query_api()
         df_result = cross_incidents_with_weather(w_query_api, norm, dmap)
         n_rows = 0 if (df_result is None) else len(df_result)
         print(f"[comparar_clima] filas cruzadas = {n_rows}")
@@ -871,19 +1014,14 @@ def comparar_clima():
     # Fallback: si hubo incidencias pero el cruce dio 0 filas, no dejamos la página en blanco
     if (df_result is None) or df_result.empty:
         print("[comparar_clima] WARNING: cross devolvió 0 con incidencias>0. Aplico fallback sin_tag.")
-        rows = []
-        for inc in norm:
-            row = {**inc}
-            row.update({
-                "viento_max": None,
-                "viento_prom": None,
-                "humedad_prom": None,
-                "temp_prom": None,
-                "humedad_prev_6h": None,
-                "_clima": "sin_tag"
-            })
-            rows.append(row)
-        df_result = pd.DataFrame(rows)
+        df_result = norm.assign(
+            viento_max=None,
+            viento_prom=None,
+            humedad_prom=None,
+            temp_prom=None,
+            humedad_prev_6h=None,
+            _clima="sin_tag",
+        )
 
     # Orden amigable si están las columnas
     if not df_result.empty:
@@ -906,26 +1044,37 @@ def comparar_clima():
 @login_required
 @admin_required
 def admin_page():
-    return render_template('admin.html', name=current_user.name)
+    return render_template('admin.html', name=current_user.name, job_id=request.args.get('job'))
 
 @main.route('/purge', methods=['POST'])
 @login_required
 @admin_required
 def purge_data():
-    def run_purge():
-        try:
-            buckets_api = influx_client.buckets_api()
-            bucket = buckets_api.find_bucket_by_name(INFLUXDB_BUCKET)
-            if bucket:
-                buckets_api.delete_bucket(bucket)
-                buckets_api.create_bucket(bucket_name=INFLUXDB_BUCKET, org=INFLUXDB_ORG)
-                print("✔ Bucket eliminado y recreado exitosamente.")
-            else:
-                print(f"⚠ Bucket '{INFLUXDB_BUCKET}' no encontrado.")
-        except Exception as e:
-            print(f"❌ Error durante recreación de bucket: {e}")
-
-    threading.Thread(target=run_purge).start()
-    flash("El bucket fue purgado y recreado. Puede demorar unos segundos en verse reflejado.", "info")
-    return redirect(url_for('main.admin_page'))
+    # Un solo cupo de purga para todos los procesos: otro clic no encola otro borrado
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    job_id = reserve_purge(upload_folder)
+    if job_id is None:
+        flash("Ya hay una purga o una carga de archivos en curso. Intente de nuevo cuando termine.", "warning")
+        return redirect(url_for('main.admin_page'))
+
+    app = current_app._get_current_object()
+
+    def on_done():
+        # La caché vive en la app: el hilo necesita su propio contexto
+        with app.app_context():
+            refresh_influx_caches()
+
+    submit_bucket_purge(upload_folder, job_id, on_done=on_done)
+    flash("La purga del bucket se está procesando en segundo plano.", "info")
+    return redirect(url_for('main.admin_page', job=job_id))
+
+@main.route('/purge/status/<job_id>')
+@login_required
+@admin_required
+def purge_status(job_id):
+    """Estado de una purga encolada por /purge."""
+    status = get_job_status(current_app.config['UPLOAD_FOLDER'], job_id)
+    if status is None:
+        return jsonify({'status': 'desconocido'}), 404
+    return jsonify({'status': status})
 
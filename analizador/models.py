@@ -23,3 +23,7 @@ class User(UserMixin, db.Model):
     # 2FA (TOTP)
     totp_secret = db.Column(db.String(64), nullable=True)
     is_2fa_enabled = db.Column(db.Boolean, default=False, nullable=False)
+
+
+# Índice funcional para búsquedas por email sin distinguir mayúsculas (login, reset, alta)
+db.Index('ix_user_email_lower', db.func.lower(User.email))
@@ -2,14 +2,224 @@
 # Contiene la lógica de negocio, como el procesamiento de archivos.
 
 import os
+import re
+import time
+import uuid
+import numpy as np
 import pandas as pd
-from . import influx_client, INFLUXDB_ORG, INFLUXDB_BUCKET
-from influxdb_client import Point
-from influxdb_client.client.write_api import SYNCHRONOUS
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from . import get_influx_client, INFLUXDB_ORG, INFLUXDB_BUCKET
+from influxdb_client.client.write_api import WriteOptions
 import pytz  # <<< NUEVO: para manejar zona horaria
 
 
+# Escritura por lotes en segundo plano (el cliente ya comprime con gzip): cada lote de
+# WRITE_BATCH_SIZE puntos viaja en un solo request, con reintentos exponenciales.
+WRITE_BATCH_SIZE = 5_000
+WRITE_OPTIONS = WriteOptions(
+    batch_size=WRITE_BATCH_SIZE,
+    flush_interval=10_000,
+    jitter_interval=2_000,
+    retry_interval=5_000,
+    max_retries=5,
+    max_retry_delay=30_000,
+    exponential_base=2,
+)
+
+# Trabajos en segundo plano sobre el bucket (cargas y purgas): /upload y /purge
+# responden apenas encolan y un único worker por proceso los corre en orden de llegada.
+_upload_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='upload')
+MAX_PENDING_UPLOADS = 5  # cargas en cola (o en curso) admitidas a la vez
+
+# El estado de cada trabajo vive en archivos dentro de UPLOAD_FOLDER/.jobs y no en
+# memoria: con varios workers de Gunicorn, /upload/status o /purge/status puede
+# atenderlo otro proceso, y los cupos son unos solos para todos.
+#   <job_id>.status  -> 'pendiente' | 'procesando' | 'ok' | 'error'
+#   slot-<n>         -> cupo ocupado por una carga pendiente o en curso
+#   purge            -> cupo único de la purga pendiente o en curso
+# Una purga y una carga se excluyen entre procesos: cada una toma su cupo y después
+# mira el de la otra; si está ocupado suelta el suyo (en una carrera pueden ceder las
+# dos, nunca pasar las dos).
+UPLOAD_SLOT_TTL = 2 * 3600  # un cupo sin tocar hace tanto es de un proceso que murió
+UPLOAD_STATUS_TTL = 24 * 3600  # los estados terminados se borran pasado un día
+_JOB_ID_RE = re.compile(r'[0-9a-f]{32}\Z')
+_UPLOAD_SLOTS = tuple(f'slot-{n}' for n in range(MAX_PENDING_UPLOADS))
+_PURGE_SLOT = 'purge'
+
+
+def _jobs_dir(upload_folder):
+    path = os.path.join(upload_folder, '.jobs')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _write_status(jobs_dir, job_id, status):
+    # os.replace es atómico: otro proceso nunca lee un archivo a medio escribir
+    tmp = os.path.join(jobs_dir, f'{job_id}.tmp')
+    with open(tmp, 'w') as f:
+        f.write(status)
+    os.replace(tmp, os.path.join(jobs_dir, f'{job_id}.status'))
+
+
+def _older_than(path, seconds):
+    try:
+        return time.time() - os.path.getmtime(path) > seconds
+    except OSError:
+        return False
+
+
+def _prune_statuses(jobs_dir):
+    for name in os.listdir(jobs_dir):
+        path = os.path.join(jobs_dir, name)
+        if name.endswith('.status') and _older_than(path, UPLOAD_STATUS_TTL):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def _take_slot(jobs_dir, name, job_id):
+    """Crea el cupo `name` a nombre de job_id; False si ya está ocupado. O_EXCL hace
+    que mirar y tomar sea un solo paso atómico, también entre procesos."""
+    slot = os.path.join(jobs_dir, name)
+    if _older_than(slot, UPLOAD_SLOT_TTL):
+        try:
+            os.remove(slot)
+        except OSError:
+            pass
+    try:
+        fd = os.open(slot, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w') as f:
+        f.write(job_id)
+    return True
+
+
+def _slot_taken(jobs_dir, name):
+    slot = os.path.join(jobs_dir, name)
+    return os.path.exists(slot) and not _older_than(slot, UPLOAD_SLOT_TTL)
+
+
+def _release_slot(jobs_dir, name, job_id):
+    slot = os.path.join(jobs_dir, name)
+    try:
+        with open(slot) as f:
+            if f.read() != job_id:
+                return False
+        os.remove(slot)
+    except OSError:
+        return False
+    return True
+
+
+def _start_job(jobs_dir, job_id):
+    _prune_statuses(jobs_dir)
+    _write_status(jobs_dir, job_id, 'pendiente')
+    return job_id
+
+
+def reserve_upload(upload_folder):
+    """Reserva un cupo de carga y devuelve el id del trabajo, o None si ya hay
+    MAX_PENDING_UPLOADS pendientes o en proceso, o una purga pendiente."""
+    jobs_dir = _jobs_dir(upload_folder)
+    job_id = uuid.uuid4().hex
+    for name in _UPLOAD_SLOTS:
+        if _take_slot(jobs_dir, name, job_id):
+            if _slot_taken(jobs_dir, _PURGE_SLOT):
+                _release_slot(jobs_dir, name, job_id)
+                return None
+            return _start_job(jobs_dir, job_id)
+    return None
+
+
+def reserve_purge(upload_folder):
+    """Reserva el cupo único de purga y devuelve el id del trabajo, o None si ya hay
+    una purga o alguna carga pendiente o en proceso."""
+    jobs_dir = _jobs_dir(upload_folder)
+    job_id = uuid.uuid4().hex
+    if not _take_slot(jobs_dir, _PURGE_SLOT, job_id):
+        return None
+    if any(_slot_taken(jobs_dir, name) for name in _UPLOAD_SLOTS):
+        _release_slot(jobs_dir, _PURGE_SLOT, job_id)
+        return None
+    return _start_job(jobs_dir, job_id)
+
+
+def release_job(upload_folder, job_id, status='error'):
+    """Libera el cupo de job_id y deja su estado final (p. ej. si falló guardar el archivo)."""
+    jobs_dir = _jobs_dir(upload_folder)
+    _write_status(jobs_dir, job_id, status)
+    for name in _UPLOAD_SLOTS + (_PURGE_SLOT,):
+        if _release_slot(jobs_dir, name, job_id):
+            return
+
+
+def submit_file_processing(filepath, job_id, on_done=None):
+    """Encola process_file_to_influxdb(filepath) para el trabajo `job_id` (reservado
+    con reserve_upload en la carpeta del archivo). `on_done` se llama al terminar
+    (haya o no error)."""
+    upload_folder = os.path.dirname(filepath)
+
+    def run():
+        status = 'error'
+        try:
+            _write_status(_jobs_dir(upload_folder), job_id, 'procesando')
+            status = 'ok' if process_file_to_influxdb(filepath) else 'error'
+        except Exception as e:
+            print(f"❌ Error en trabajo de carga {job_id}: {e}")
+        finally:
+            release_job(upload_folder, job_id, status)
+            if on_done:
+                on_done()
+
+    _upload_executor.submit(run)
+    return job_id
+
+
+def submit_bucket_purge(upload_folder, job_id, on_done=None):
+    """Encola el borrado y la recreación del bucket de incidencias para el trabajo
+    `job_id` (reservado con reserve_purge). `on_done` se llama al terminar (haya o no
+    error)."""
+    def run():
+        status = 'error'
+        try:
+            _write_status(_jobs_dir(upload_folder), job_id, 'procesando')
+            buckets_api = get_influx_client().buckets_api()
+            bucket = buckets_api.find_bucket_by_name(INFLUXDB_BUCKET)
+            if bucket:
+                buckets_api.delete_bucket(bucket)
+                buckets_api.create_bucket(bucket_name=INFLUXDB_BUCKET, org=INFLUXDB_ORG)
+                print("✔ Bucket eliminado y recreado exitosamente.")
+                status = 'ok'
+            else:
+                print(f"⚠ Bucket '{INFLUXDB_BUCKET}' no encontrado.")
+        except Exception as e:
+            print(f"❌ Error durante recreación de bucket: {e}")
+        finally:
+            release_job(upload_folder, job_id, status)
+            if on_done:
+                on_done()
+
+    _upload_executor.submit(run)
+    return job_id
+
+
+def get_job_status(upload_folder, job_id):
+    """Estado de un trabajo de carga o purga, o None si no existe (o ya se descartó)."""
+    if not _JOB_ID_RE.match(job_id):
+        return None
+    path = os.path.join(_jobs_dir(upload_folder), f'{job_id}.status')
+    try:
+        with open(path) as f:
+            status = f.read()
+    except OSError:
+        return None
+    if status in ('pendiente', 'procesando') and _older_than(path, UPLOAD_SLOT_TTL):
+        return 'error'  # el proceso que lo tenía ya no existe
+    return status
+
+
 def to_int(value):
     """Convierte un valor a entero de forma segura, devolviendo 0 si falla."""
     try:
@@ -17,40 +227,139 @@ def to_int(value):
     except (ValueError, TypeError):
         return 0
 
+# Nombre estándar de cada columna → nombres aceptados en los CSV de origen (se usa el
+# primero que aparezca)
+COLUMN_ALIASES = {
+    'nro_incidencia': ['nro_incidencia', 'incidencia'],
+    'fecha_inicio': ['fecha_inicio', 'fecha_de_alta'],
+    'fecha_fin': ['fecha_fin', 'fecha_de_reposicion'],
+    'distrito': ['distrito'],
+    'nivel_tension': ['nivel_tension', 'MT-BT'],
+    'localidad': ['localidad'],
+    'distribuidor': ['distribuidor'],
+    'instalacion': ['instalacion'],
+    'ct_involucrados': ['ct_involucrados', 'cantidad_de_ct_afectados'],
+    'nises_involucrados': ['nises_involucrados', 'clientes_afectados'],
+    'potencia_involucrada': ['potencia_involucrada', 'potencia_instalada'],
+    'descripcion_de_la_causa': ['descripcion_de_la_causa'],
+    'cantidad_de_reclamos': ['cantidad_de_reclamos', 'cant_reclamos', 'cantidad de reclamos'],
+    'extraccion': ['extraccion']
+}
+KNOWN_COLUMNS = frozenset(alias for aliases in COLUMN_ALIASES.values() for alias in aliases)
+
+# Line protocol de la medición incidencia_electrica. Se arma por columnas (operaciones
+# de texto de pandas) en lugar de un Point por fila, con el mismo escape y las mismas
+# reglas que Point: tags vacíos y floats no finitos se omiten, tags y fields en orden.
+TZ_LOCAL = pytz.timezone("America/Argentina/San_Luis")
+LP_TAGS = ('descripcion_de_la_causa', 'distribuidor', 'distrito', 'instalacion', 'localidad', 'nivel_tension')
+LP_INT_FIELDS = ('cantidad_de_reclamos', 'ct_involucrados', 'nises_involucrados')
+# field → columna del DataFrame ya normalizado
+LP_STR_FIELDS = {
+    'extraccion': 'extraccion',
+    'fecha_fin': 'fecha_fin_fecha',
+    'fecha_inicio': 'fecha_inicio_fecha',
+    'hora_fin': 'fecha_fin_hora',
+    'hora_inicio': 'fecha_inicio_hora',
+    'nro_incidencia': 'nro_incidencia',
+}
+_LP_KEY_ESCAPES = str.maketrans({',': r'\,', '=': r'\=', ' ': r'\ ', '\n': r'\n', '\t': r'\t', '\r': r'\r'})
+_LP_STR_ESCAPES = str.maketrans({'\\': '\\\\', '"': '\\"'})
+
+
+def _lp_text(df, col):
+    """Columna como texto, como str(valor) (NaN → 'nan'); '' si la columna no existe."""
+    if col not in df.columns:
+        return pd.Series('', index=df.index)
+    values = df[col]
+    return values.where(values.notna(), 'nan').astype(str)
+
+
+def _lp_coerce(values, conv):
+    """(números, fallidos) de convertir cada valor con conv, como el int()/float() del
+    loop de Point. Las columnas numéricas se convierten vectorizadas; sólo las de texto
+    (CSV con valores no numéricos, p. ej. '2,5' o '2.5' en un entero) van fila por fila."""
+    if pd.api.types.is_numeric_dtype(values):
+        return pd.to_numeric(values), pd.Series(False, index=values.index)
+    num = np.empty(len(values))
+    failed = np.zeros(len(values), dtype=bool)
+    for i, value in enumerate(values):
+        try:
+            num[i] = conv(value)
+        except (ValueError, TypeError, OverflowError):
+            num[i] = np.nan
+            failed[i] = True
+    return pd.Series(num, index=values.index), pd.Series(failed, index=values.index)
+
+
+def _lp_float(values):
+    """Valor float como lo escribe Point (sin '.0' final); None si no es finito."""
+    num = pd.to_numeric(values, errors='coerce')
+    text = num.astype(str).str.replace(r'\.0$', '', regex=True)
+    return text.where(np.isfinite(num), None)
+
+
+def _incidents_line_protocol(df, ini):
+    """Líneas de line protocol de cada fila válida y cantidad de filas descartadas.
+    `ini` es el inicio del incidente (hora local sin TZ): es el _time del punto."""
+    n = len(df)
+    zero = pd.Series(0, index=df.index)
+    invalid = pd.Series(False, index=df.index)
+
+    line = pd.Series('incidencia_electrica', index=df.index)
+    for tag in LP_TAGS:
+        value = _lp_text(df, tag).str.translate(_LP_KEY_ESCAPES)
+        value = value.where(~value.str.endswith('\\'), value + ' ')
+        line = line + (',' + tag + '=' + value).where(value != '', '')
+
+    fields = {}
+    # Como en el loop de Point, una fila que no convierte se descarta (int(NaN), '2.5', '2,5')
+    for field in LP_INT_FIELDS:
+        num, failed = _lp_coerce(df[field], int) if field in df.columns else (zero, False)
+        invalid |= failed | ~np.isfinite(num)
+        fields[field] = num.where(np.isfinite(num), 0).astype('int64').astype(str) + 'i'
+    for field, col in LP_STR_FIELDS.items():
+        fields[field] = '"' + _lp_text(df, col).str.translate(_LP_STR_ESCAPES) + '"'
+    fields['indice'] = pd.Series(np.arange(1, n + 1), index=df.index).astype(str) + 'i'
+    potencia, failed = _lp_coerce(df['potencia_involucrada'], float) if 'potencia_involucrada' in df.columns else (zero, False)
+    invalid |= failed  # NaN/inf sí pasan: Point omite el field
+    fields['potencia_involucrada'] = _lp_float(potencia)
+    if 'dur_min' in df.columns:
+        fields['dur_min'] = _lp_float(df['dur_min'])
+
+    field_set = pd.Series('', index=df.index)
+    for field in sorted(fields):
+        field_set = field_set + (',' + field + '=' + fields[field]).fillna('')
+    line = line + ' ' + field_set.str[1:]
+
+    # _time: inicio local (San Luis) → UTC en nanosegundos
+    local = ini.dt.tz_localize(TZ_LOCAL, ambiguous='NaT', nonexistent='NaT')
+    invalid |= local.isna()
+    utc = local.dt.tz_convert('UTC').dt.tz_localize(None)
+    ns = utc.where(~invalid, pd.Timestamp(0)).astype('datetime64[ns]').astype('int64')
+    line = line + ' ' + ns.astype(str)
+
+    return line[~invalid].tolist(), int(invalid.sum())
+
+
 def process_file_to_influxdb(filepath):
     """Lee un archivo CSV de incidencias, lo normaliza y lo inserta en InfluxDB optimizadamente."""
     print(f"\n--- Iniciando procesamiento de {os.path.basename(filepath)} ---")
 
-    column_mapping = {
-        'nro_incidencia': ['nro_incidencia', 'incidencia'],
-        'fecha_inicio': ['fecha_inicio', 'fecha_de_alta'],
-        'fecha_fin': ['fecha_fin', 'fecha_de_reposicion'],
-        'distrito': ['distrito'],
-        'nivel_tension': ['nivel_tension', 'MT-BT'],
-        'localidad': ['localidad'],
-        'distribuidor': ['distribuidor'],
-        'instalacion': ['instalacion'],
-        'ct_involucrados': ['ct_involucrados', 'cantidad_de_ct_afectados'],
-        'nises_involucrados': ['nises_involucrados', 'clientes_afectados'],
-        'potencia_involucrada': ['potencia_involucrada', 'potencia_instalada'],
-        'descripcion_de_la_causa': ['descripcion_de_la_causa'],
-        'cantidad_de_reclamos': ['cantidad_de_reclamos', 'cant_reclamos', 'cantidad de reclamos'],
-        'extraccion': ['extraccion']
-    }
-
     try:
         filename = os.path.basename(filepath).lower()
         if filename.endswith('.csv'):
-            df = pd.read_csv(filepath, encoding='latin1', sep=',', index_col=False)
+            # Sólo se parsean las columnas que la carga usa (ver COLUMN_ALIASES)
+            df = pd.read_csv(filepath, encoding='latin1', sep=',', index_col=False,
+                             usecols=lambda c: c in KNOWN_COLUMNS)
         else:
             print(f"Error: Solo se permite formato CSV. Archivo: {filename}")
-            return
+            return False
 
         print(f"Pandas leyó {len(df)} filas.")
 
         # Normalizar nombres de columnas
         new_columns = {}
-        for std_name, aliases in column_mapping.items():
+        for std_name, aliases in COLUMN_ALIASES.items():
             for alias in aliases:
                 if alias in df.columns:
                     new_columns[alias] = std_name
@@ -65,68 +374,36 @@ def process_file_to_influxdb(filepath):
             fecha = pd.to_datetime(df[col], format='%Y%m%d %H:%M:%S', errors='coerce')
             df[f'{col}_fecha'] = fecha.dt.strftime('%d-%m-%Y')
             df[f'{col}_hora'] = fecha.dt.strftime('%H:%M:%S')
+            return fecha
 
         if 'fecha_inicio' in df.columns:
-            parse_fecha_hora('fecha_inicio')
+            ini = parse_fecha_hora('fecha_inicio')
         if 'fecha_fin' in df.columns:
-            parse_fecha_hora('fecha_fin')
+            fin = parse_fecha_hora('fecha_fin')
+            # Duración en minutos precalculada: /graficos la lee tal cual sin reparsear el fin
+            df['dur_min'] = (fin - ini).dt.total_seconds() / 60.0
 
         df.drop(columns=['fecha_inicio', 'fecha_fin'], inplace=True, errors='ignore')
 
-        write_api = influx_client.write_api(write_options=SYNCHRONOUS)
+        failed = []
+        write_api = get_influx_client().write_api(
+            write_options=WRITE_OPTIONS,
+            error_callback=lambda conf, data, exc: failed.append(exc),
+        )
 
-        batch = []
-        for i, row in enumerate(df.itertuples(index=False), 1):
-            try:
-                point = Point("incidencia_electrica") \
-                    .tag("nivel_tension", str(getattr(row, "nivel_tension", ""))) \
-                    .tag("distrito", str(getattr(row, "distrito", ""))) \
-                    .tag("localidad", str(getattr(row, "localidad", ""))) \
-                    .tag("distribuidor", str(getattr(row, "distribuidor", ""))) \
-                    .tag("instalacion", str(getattr(row, "instalacion", ""))) \
-                    .tag("descripcion_de_la_causa", str(getattr(row, "descripcion_de_la_causa", ""))) \
-                    .field("ct_involucrados", int(getattr(row, "ct_involucrados", 0))) \
-                    .field("nises_involucrados", int(getattr(row, "nises_involucrados", 0))) \
-                    .field("potencia_involucrada", float(getattr(row, "potencia_involucrada", 0))) \
-                    .field("cantidad_de_reclamos", int(getattr(row, "cantidad_de_reclamos", 0))) \
-                    .field("nro_incidencia", str(getattr(row, "nro_incidencia", ""))) \
-                    .field("extraccion", str(getattr(row, "extraccion", ""))) \
-                    .field("fecha_inicio", str(getattr(row, "fecha_inicio_fecha", ""))) \
-                    .field("hora_inicio", str(getattr(row, "fecha_inicio_hora", ""))) \
-                    .field("fecha_fin", str(getattr(row, "fecha_fin_fecha", ""))) \
-                    .field("hora_fin", str(getattr(row, "fecha_fin_hora", ""))) \
-                    .field("indice", i) \
-                    .time((lambda: (
-                        # --- Manejo de _time = fecha/hora REAL de inicio del incidente ---
-                        # Tomamos los strings normalizados por el pipeline previo:
-                        #   fecha_inicio_fecha: "DD-MM-YYYY"
-                        #   fecha_inicio_hora : "HH:MM:SS"
-                        # Convertimos a zona local America/Argentina/San_Luis y luego a UTC.
-                        (lambda fi_fecha, fi_hora: (
-                            (lambda dt_utc: dt_utc)(
-                                (lambda:
-                                    # Intento de parseo local → UTC
-                                    pytz.timezone("America/Argentina/San_Luis")
-                                        .localize(datetime.strptime(f"{fi_fecha} {fi_hora}", "%d-%m-%Y %H:%M:%S"))
-                                        .astimezone(pytz.utc)
-                                )() if (fi_fecha and fi_hora) else
-                                # Fallback si viniera vacío
-                                datetime.utcnow().replace(tzinfo=pytz.utc)
-                            )
-                        ))(str(getattr(row, "fecha_inicio_fecha", "")).strip(),
-                           str(getattr(row, "fecha_inicio_hora",  "")).strip())
-                    ))())
-                batch.append(point)
-
-                if len(batch) >= 500:
-                    write_api.write(bucket=INFLUXDB_BUCKET, org=INFLUXDB_ORG, record=batch)
-                    batch.clear()
-            except Exception as e:
-                print(f"Error procesando fila {i}: {e}")
-
-        if batch:
-            write_api.write(bucket=INFLUXDB_BUCKET, org=INFLUXDB_ORG, record=batch)
-
-        print(f"✓ Se insertaron {len(df)} puntos en InfluxDB.")
+        lines, n_invalid = _incidents_line_protocol(df, ini)
+        if n_invalid:
+            print(f"Se descartaron {n_invalid} filas con fecha de inicio o valores numéricos inválidos.")
+        # El WriteApi en modo batching arma los lotes de WRITE_BATCH_SIZE por su cuenta
+        write_api.write(bucket=INFLUXDB_BUCKET, org=INFLUXDB_ORG, record=lines)
+        # close() vacía los lotes pendientes y espera a que terminen de enviarse
+        write_api.close()
+
+        if failed:
+            print(f"❌ Fallaron {len(failed)} lotes al escribir en InfluxDB: {failed[0]}")
+            return False
+        print(f"✓ Se insertaron {len(lines)} puntos en InfluxDB.")
+        return True
     except Exception as e:
         print(f"❌ Error general procesando archivo: {e}")
+        return False
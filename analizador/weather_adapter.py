@@ -1,7 +1,9 @@
 # /analizador/weather_adapter.py
 import os
+import numpy as np
 import pandas as pd
 from datetime import timedelta
+from functools import lru_cache
 import pytz
 
 from . import (
@@ -11,6 +13,7 @@ from . import (
     WEATHER_HUM_FIELD,
     WEATHER_TEMP_FIELD,
     WEATHER_SITE_TAG_KEY,
+    flux_str,
 )
 
 TZ = pytz.timezone("America/Argentina/San_Luis")
@@ -20,7 +23,6 @@ def _to_utc_string(dt):
     Convierte un datetime (naive en hora local o aware en cualquier tz)
     a string UTC ISO8601 sin comillas para Flux range(): YYYY-MM-DDTHH:MM:SSZ
     """
-    import pytz
     if getattr(dt, "tzinfo", None) is None:
         dt = TZ.localize(dt)          # naive → local tz
     dt_utc = dt.astimezone(pytz.utc)  # a UTC
@@ -37,51 +39,54 @@ def _fields_enabled():
 def load_distrito_tags(csv_path: str):
     """
     Lee `distrito,weather_tag` → dict {DISTRITO: TAG} en MAYÚSCULAS y sin espacios.
+    El CSV se parsea sólo cuando cambia (se cachea por fecha de modificación).
     """
-    import os, pandas as pd
     if not os.path.exists(csv_path):
         raise FileNotFoundError(f"No existe el CSV de tags: {csv_path}")
+    return dict(_load_distrito_tags(csv_path, os.path.getmtime(csv_path)))
+
+@lru_cache(maxsize=4)
+def _load_distrito_tags(csv_path, mtime):
     df = pd.read_csv(csv_path)
     cols = {c.strip().lower(): c for c in df.columns}
     if not {"distrito", "weather_tag"}.issubset(cols):
         raise ValueError("CSV debe tener columnas 'distrito' y 'weather_tag'.")
-    df = df.rename(columns={cols["distrito"]: "distrito", cols["weather_tag"]: "weather_tag"})
-    out = {}
-    for _, r in df.iterrows():
-        d = str(r["distrito"]).strip().upper()
-        t = str(r["weather_tag"]).strip().upper()
-        if d and t:
-            out[d] = t
-    return out
+    d = df[cols["distrito"]].map(str).str.strip().str.upper()
+    t = df[cols["weather_tag"]].map(str).str.strip().str.upper()
+    keep = (d != "") & (t != "")
+    return dict(zip(d[keep], t[keep]))
 
 
 
 # ---------------------- Query a Influx de clima -----------------------
 
-def fetch_weather_df(query_api, tag_value: str, start_utc: str, stop_utc: str) -> pd.DataFrame:
+def fetch_weather_dfs(query_api, tag_values, start_utc: str, stop_utc: str) -> dict:
     """
-    Devuelve DataFrame con columnas: _time, _field, _value
+    Devuelve {tag: DataFrame con columnas _time, _field, _value} en una sola query
+    para todos los tags pedidos (un round-trip en lugar de uno por distrito).
     Filtra por:
       - bucket: WEATHER_INFLUX_BUCKET
       - measurement: WEATHER_MEASUREMENT
-      - tag key: WEATHER_SITE_TAG_KEY == tag_value  (por ej., equip_grp == 'ETSL')
+      - tag key: WEATHER_SITE_TAG_KEY en tag_values  (por ej., equip_grp == 'ETSL')
       - fields presentes (windspeed, temperature y opcionalmente humedad)
-    Aplica aggregateWindow 1h mean y elimina NaNs.
+    Aplica aggregateWindow 1h mean y elimina NaNs. Los tags sin datos no aparecen.
     """
     fields = _fields_enabled()
-    if not fields:
-        return pd.DataFrame()  # nada que pedir si no hay fields configurados
+    tag_values = sorted(set(tag_values))
+    if not fields or not tag_values:
+        return {}  # nada que pedir si no hay fields configurados
 
     field_filter = " or ".join([f'r._field == "{f}"' for f in fields])
+    tag_filter = " or ".join([f'r["{WEATHER_SITE_TAG_KEY}"] == {flux_str(t)}' for t in tag_values])
 
     flux = f'''
 from(bucket: "{WEATHER_INFLUX_BUCKET}")
   |> range(start: {start_utc}, stop: {stop_utc})
   |> filter(fn: (r) => r._measurement == "{WEATHER_MEASUREMENT}")
-  |> filter(fn: (r) => r["{WEATHER_SITE_TAG_KEY}"] == "{tag_value}")
+  |> filter(fn: (r) => {tag_filter})
   |> filter(fn: (r) => {field_filter})
   |> aggregateWindow(every: 1h, fn: mean, createEmpty: false)
-  |> keep(columns: ["_time","_field","_value"])
+  |> keep(columns: ["_time","_field","_value","{WEATHER_SITE_TAG_KEY}"])
   |> yield()
 '''
 
@@ -90,74 +95,96 @@ from(bucket: "{WEATHER_INFLUX_BUCKET}")
     # El cliente puede devolver una lista de DataFrames
     if isinstance(df, list):
         if len(df) == 0:
-            return pd.DataFrame()
+            return {}
         df = pd.concat(df, ignore_index=True)
 
     if df is None or df.empty:
-        return pd.DataFrame()
+        return {}
 
     # Normalizar tipos y limpiar
     df["_time"] = pd.to_datetime(df["_time"], utc=True, errors="coerce")
     df = df.dropna(subset=["_time", "_value"])
-    return df
+    return {tag: sub[["_time", "_field", "_value"]] for tag, sub in df.groupby(WEATHER_SITE_TAG_KEY)}
 
 # ---------------------- Métricas por incidencia -----------------------
 
-def compute_metrics_for_incident(df_weather: pd.DataFrame, t0_local, t1_local):
+_EMPTY_METRICS = {
+    "viento_max": None,
+    "viento_prom": None,
+    "humedad_prom": None,
+    "temp_prom": None,
+    "humedad_prev_6h": None,
+}
+_PREV_WINDOW_NS = int(timedelta(hours=6).total_seconds()) * 10**9
+
+def _utc_ns(datetimes):
+    """Instantes (naive en hora local o aware) como int64 ns UTC."""
+    idx = pd.DatetimeIndex(list(datetimes))
+    if idx.tz is None:
+        idx = idx.tz_localize(TZ)
+    return idx.tz_convert("UTC").tz_localize(None).values.astype("datetime64[ns]").astype(np.int64)
+
+class _FieldSeries:
+    """Serie de un field ordenada por tiempo, con sumas acumuladas: el promedio de
+    cualquier ventana sale de dos búsquedas binarias, sin recorrer la serie."""
+
+    def __init__(self, df_weather, field):
+        sub = df_weather.loc[df_weather["_field"] == field, ["_time", "_value"]] if field else df_weather.iloc[:0]
+        sub = sub.sort_values("_time", kind="mergesort")
+        self.times = sub["_time"].values.astype("datetime64[ns]").astype(np.int64)
+        self.values = sub["_value"].to_numpy(dtype=float)
+        self.csum = np.concatenate(([0.0], np.cumsum(self.values)))
+
+    def bounds(self, lo_ns, hi_ns, hi_side):
+        return (np.searchsorted(self.times, lo_ns, side="left"),
+                np.searchsorted(self.times, hi_ns, side=hi_side))
+
+    def means(self, lo, hi):
+        n = hi - lo
+        with np.errstate(invalid="ignore", divide="ignore"):
+            out = (self.csum[hi] - self.csum[lo]) / n
+        return [float(v) if k else None for v, k in zip(out, n)]
+
+    def maxes(self, lo, hi):
+        return [float(self.values[a:b].max()) if b > a else None for a, b in zip(lo, hi)]
+
+def compute_metrics_for_incidents(df_weather: pd.DataFrame, starts, ends):
     """
-    Calcula:
-      - viento_max / viento_prom (sobre ventana de la incidencia)
+    Para cada incidencia (inicio, fin) calcula:
+      - viento_max / viento_prom (sobre ventana de la incidencia, extremos incluidos)
       - temp_prom                 (idem)
       - humedad_prom              (idem, opcional)
       - humedad_prev_6h          (6 horas previas al inicio, opcional)
     Si algún field no existe/está vacío, devuelve None para esa métrica.
     """
-    if df_weather is None or df_weather.empty:
-        return {
-            "viento_max": None,
-            "viento_prom": None,
-            "humedad_prom": None,
-            "temp_prom": None,
-            "humedad_prev_6h": None,
+    n = len(starts)
+    if df_weather is None or df_weather.empty or n == 0:
+        return [dict(_EMPTY_METRICS) for _ in range(n)]
+
+    t0 = _utc_ns(starts)
+    t1 = _utc_ns(ends)
+
+    wind = _FieldSeries(df_weather, WEATHER_WIND_FIELD)
+    lo, hi = wind.bounds(t0, t1, "right")
+    viento_max, viento_prom = wind.maxes(lo, hi), wind.means(lo, hi)
+
+    temp = _FieldSeries(df_weather, WEATHER_TEMP_FIELD)
+    temp_prom = temp.means(*temp.bounds(t0, t1, "right"))
+
+    hum = _FieldSeries(df_weather, WEATHER_HUM_FIELD)
+    humedad_prom = hum.means(*hum.bounds(t0, t1, "right"))
+    humedad_prev = hum.means(*hum.bounds(t0 - _PREV_WINDOW_NS, t0, "left"))
+
+    return [
+        {
+            "viento_max": viento_max[i],
+            "viento_prom": viento_prom[i],
+            "humedad_prom": humedad_prom[i],
+            "temp_prom": temp_prom[i],
+            "humedad_prev_6h": humedad_prev[i],
         }
-
-    def _to_utc(dt):
-        if getattr(dt, "tzinfo", None) is None:
-            return TZ.localize(dt).astimezone(pytz.utc)
-        return dt.astimezone(pytz.utc)
-
-    t0_utc = _to_utc(t0_local)
-    t1_utc = _to_utc(t1_local)
-
-    mask_win = (df_weather["_time"] >= t0_utc) & (df_weather["_time"] <= t1_utc)
-    mask_prev6 = (df_weather["_time"] < t0_utc) & (df_weather["_time"] >= t0_utc - timedelta(hours=6))
-
-    def _max_mean(field):
-        if not field:
-            return (None, None)
-        s = df_weather.loc[mask_win & (df_weather["_field"] == field), "_value"]
-        if s.empty:
-            return (None, None)
-        return (float(s.max()), float(s.mean()))
-
-    def _mean(field, mask):
-        if not field:
-            return None
-        s = df_weather.loc[mask & (df_weather["_field"] == field), "_value"]
-        return float(s.mean()) if not s.empty else None
-
-    viento_max, viento_prom = _max_mean(WEATHER_WIND_FIELD)
-    temp_prom    = _mean(WEATHER_TEMP_FIELD, mask_win)
-    humedad_prom = _mean(WEATHER_HUM_FIELD, mask_win)
-    humedad_prev = _mean(WEATHER_HUM_FIELD, mask_prev6)
-
-    return {
-        "viento_max": viento_max,
-        "viento_prom": viento_prom,
-        "humedad_prom": humedad_prom,
-        "temp_prom": temp_prom,
-        "humedad_prev_6h": humedad_prev,
-    }
+        for i in range(n)
+    ]
 
 # ---------------------- Validación de incidencias ---------------------
 
@@ -183,46 +210,51 @@ def _require_keys_for_cross(incidents):
 # ---------------------- Cruce incidencias ↔ clima ---------------------
 
 def cross_incidents_with_weather(query_api, incidents, distrito_tags):
-    from collections import defaultdict
-    import pytz
-    from datetime import timedelta
-
-    TZ = pytz.timezone("America/Argentina/San_Luis")
-
-    by_d = defaultdict(list)
-    for inc in incidents:
-        by_d[inc.get("distrito") or ""].append(inc)
-
-    rows = []
-    print(f"[cross] grupos por distrito = {len(by_d)}")
-    for d, items in by_d.items():
-        key = (str(d) or "").strip().upper()
-        tag = distrito_tags.get(key)
-        print(f"[cross] d={key!r} n_inc={len(items)} tag={tag!r}")
-
-        # ventana extendida -6h
-        t0 = min(i["dt_inicio_local"] for i in items)
-        t1 = max(i["dt_fin_local"]   for i in items)
+    """
+    Cruza las incidencias (DataFrame con distrito, dt_inicio_local y dt_fin_local, o
+    lista de dicts) con el clima de su distrito. Devuelve un DataFrame con las columnas
+    de la incidencia más weather_tag, las métricas de clima y _clima.
+    """
+    inc_df = incidents if isinstance(incidents, pd.DataFrame) else pd.DataFrame(incidents)
+    if inc_df.empty:
+        return pd.DataFrame()
+
+    groups = inc_df.groupby(inc_df["distrito"].fillna("").astype(str), sort=False)
+    tags = {d: distrito_tags.get(d.strip().upper()) for d in groups.groups}
+    print(f"[cross] grupos por distrito = {len(tags)}")
+
+    # Clima de todos los distritos con tag en una sola query, sobre la ventana que
+    # cubre todas sus incidencias (extendida -6h)
+    mapped = inc_df[inc_df["distrito"].fillna("").astype(str).map(tags).notna()]
+    weather = {}
+    if not mapped.empty:
+        t0 = mapped["dt_inicio_local"].min()
+        t1 = mapped["dt_fin_local"].max()
         start_utc = _to_utc_string(t0 - timedelta(hours=6))
         stop_utc  = _to_utc_string(t1)
+        weather = fetch_weather_dfs(query_api, [t for t in tags.values() if t], start_utc, stop_utc)
+        print(f"[cross] clima tags con datos={len(weather)} (rango {start_utc}..{stop_utc})")
+
+    parts = []
+    for d, items in groups:
+        tag = tags[d]
+        print(f"[cross] d={d.strip().upper()!r} n_inc={len(items)} tag={tag!r}")
 
         if not tag:
             # sin mapeo: devolvemos filas con _clima="sin_tag"
-            for inc in items:
-                row = {**inc, "weather_tag": None,
-                       "viento_max": None, "viento_prom": None,
-                       "humedad_prom": None, "temp_prom": None, "humedad_prev_6h": None,
-                       "_clima": "sin_tag"}
-                rows.append(row)
-            continue
-
-        dfw = fetch_weather_df(query_api, tag, start_utc, stop_utc)
-        print(f"[cross]   clima filas={0 if dfw is None else len(dfw)} (rango {start_utc}..{stop_utc})")
-
-        for inc in items:
-            mets = compute_metrics_for_incident(dfw, inc["dt_inicio_local"], inc["dt_fin_local"])
-            row = {**inc, "weather_tag": tag, **mets}
-            row["_clima"] = "ok" if dfw is not None and not dfw.empty else "sin_datos"
-            rows.append(row)
-
-    return pd.DataFrame(rows)
\ No newline at end of file
+            metrics = pd.DataFrame([_EMPTY_METRICS] * len(items), index=items.index)
+            estado = "sin_tag"
+        else:
+            dfw = weather.get(tag)
+            print(f"[cross]   clima filas={0 if dfw is None else len(dfw)}")
+            metrics = pd.DataFrame(
+                compute_metrics_for_incidents(dfw, items["dt_inicio_local"], items["dt_fin_local"]),
+                index=items.index)
+            estado = "ok" if dfw is not None and not dfw.empty else "sin_datos"
+
+        part = items.assign(weather_tag=tag)
+        part = pd.concat([part, metrics], axis=1)
+        part["_clima"] = estado
+        parts.append(part)
+
+    return pd.concat(parts).reset_index(drop=True)
@@ -4,9 +4,9 @@
 import os
 import sqlite3
 
-def column_exists(cur, table, column):
+def table_columns(cur, table):
     cur.execute(f"PRAGMA table_info({table});")
-    return any(row[1] == column for row in cur.fetchall())
+    return {row[1] for row in cur.fetchall()}
 
 def run(db_path):
     conn = sqlite3.connect(db_path)
@@ -22,14 +22,27 @@ def run(db_path):
     addcol("last_login_at", "DATETIME NULL")
     addcol("totp_secret", "TEXT NULL")
     addcol("is_2fa_enabled", "INTEGER DEFAULT 0 NOT NULL")
+    addcol("last_totp_step", "INTEGER DEFAULT 0 NOT NULL")
+    addcol("totp_failed_attempts", "INTEGER DEFAULT 0 NOT NULL")
+    addcol("totp_lock_until", "DATETIME NULL")
 
+    # Una sola lectura de esquema por tabla y una sola transacción (un único fsync)
+    cols = {table: table_columns(cur, table) for table in ("user", "users")}
+    existing = cols["user"] | cols["users"]
+    cur.execute("BEGIN")
     for name, type_ in ops:
-        if not column_exists(cur, "user", name) and not column_exists(cur, "users", name):
+        if name not in existing:
             try:
                 cur.execute(f"ALTER TABLE users ADD COLUMN {name} {type_};")
                 print(f"Agregada columna: {name}")
             except Exception as e:
                 print(f"No se pudo agregar {name}: {e}")
+
+    # Índice funcional de email en minúsculas (create_all no lo agrega a tablas existentes)
+    for table in ("user", "users"):
+        if "email" in cols[table]:
+            cur.execute(f'CREATE INDEX IF NOT EXISTS ix_{table}_email_lower ON "{table}" (lower(email));')
+            print(f"Índice lower(email) asegurado en {table}")
     conn.commit(); conn.close()
 
 if __name__ == '__main__':
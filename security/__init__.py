@@ -1,5 +1,6 @@
 import os
 import datetime as dt
+from contextlib import contextmanager
 from flask import current_app
 from flask_login import LoginManager
 from flask_wtf import CSRFProtect
@@ -27,6 +28,19 @@ def get_db():
         raise RuntimeError("Security DB not initialized. Call security.init_app(app) first.")
     return Session()
 
+@contextmanager
+def db_session():
+    """Session for a block: rolled back if the block raises, always closed.
+    Commits stay explicit in the caller."""
+    session = get_db()
+    try:
+        yield session
+    except BaseException:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
 def init_db(app):
     global engine, Session
     uri = app.config.get("SECURITY_DATABASE_URI")
@@ -65,8 +79,11 @@ def init_app(app):
     # CSRF
     csrf.init_app(app)
 
-    # Mail
+    # Mail (rotate the SMTP session every N messages on long batches)
+    app.config.setdefault("MAIL_MAX_EMAILS", 100)
     mail.init_app(app)
+    from . import mailer
+    mailer.init_app(app)
 
     # DB
     init_db(app)
@@ -78,11 +95,8 @@ def init_app(app):
     from .models import User
     @login_manager.user_loader
     def load_user(user_id):
-        session = get_db()
-        try:
+        with db_session() as session:
             return session.get(User, int(user_id))
-        finally:
-            session.close()
 
     # Register blueprint
     from .routes import bp as security_bp
@@ -3,10 +3,17 @@ from flask import current_app
 from flask_mail import Message
 from . import mail
 
-def _serializer():
+def _serializer(purpose: str = ""):
+    # One serializer per app and purpose, rebuilt only if the secret or salt change.
+    # The purpose goes into the salt so a token for one flow is rejected by the other.
     secret = current_app.config["SECRET_KEY"]
-    salt = current_app.config["SECURITY_PASSWORD_SALT"]
-    return URLSafeTimedSerializer(secret_key=secret, salt=salt)
+    salt = current_app.config["SECURITY_PASSWORD_SALT"] + purpose
+    cached = current_app.extensions.setdefault("security_serializer", {})
+    key, s = cached.get(purpose, (None, None))
+    if key != (secret, salt):
+        s = URLSafeTimedSerializer(secret_key=secret, salt=salt)
+        cached[purpose] = ((secret, salt), s)
+    return s
 
 def generate_reset_token(email: str) -> str:
     s = _serializer()
@@ -16,8 +23,40 @@ def verify_reset_token(token: str, max_age=3600) -> str:
     s = _serializer()
     return s.loads(token, max_age=max_age)
 
-def send_reset_email(to_email: str, reset_url: str):
-    msg = Message(subject="Restablecer contraseña",
-                  recipients=[to_email],
-                  body=f"Para restablecer tu contraseña, abrí este enlace:\n\n{reset_url}\n\nSi no lo solicitaste, ignorá este email.")
-    mail.send(msg)
+def generate_2fa_token(user_id: int) -> str:
+    return _serializer("-2fa").dumps(user_id)
+
+def verify_2fa_token(token: str, max_age=300) -> int:
+    return int(_serializer("-2fa").loads(token, max_age=max_age))
+
+def _reset_message(to_email: str, reset_url: str) -> Message:
+    return Message(subject="Restablecer contraseña",
+                   recipients=[to_email],
+                   body=f"Para restablecer tu contraseña, abrí este enlace:\n\n{reset_url}\n\nSi no lo solicitaste, ignorá este email.")
+
+def send_reset_email(to_email: str, reset_url: str, connection=None):
+    msg = _reset_message(to_email, reset_url)
+    if connection is not None:
+        # Reuse an open SMTP session (no TLS/AUTH handshake per email)
+        connection.send(msg)
+        return
+    with mail.connect() as conn:
+        conn.send(msg)
+
+def send_reset_emails(pairs):
+    """Send (to_email, reset_url) resets over a single SMTP connection (Flask-Mail
+    reconnects every MAIL_MAX_EMAILS). Stops once more than a third of the batch
+    has failed. Returns (sent, failed) with the failed addresses."""
+    pairs = list(pairs)
+    sent, failed = 0, []
+    with mail.connect() as conn:
+        for to_email, reset_url in pairs:
+            try:
+                send_reset_email(to_email, reset_url, connection=conn)
+                sent += 1
+            except Exception as e:
+                current_app.logger.error("Reset email to %s failed: %s", to_email, e)
+                failed.append(to_email)
+                if len(failed) * 3 > len(pairs):
+                    break
+    return sent, failed
@@ -0,0 +1,66 @@
+import queue
+import smtplib
+import threading
+
+from . import mail
+from .email import send_reset_email
+
+# Seconds without new emails before the worker closes the SMTP session
+IDLE_TIMEOUT = 30
+
+_queue = queue.Queue()
+_app = None
+_worker = None
+_lock = threading.Lock()
+
+def init_app(app):
+    global _app
+    _app = app
+
+def enqueue(to_email: str, reset_url: str):
+    """Queue a reset email; the worker thread sends it outside the request."""
+    _ensure_worker()
+    _queue.put((to_email, reset_url))
+
+def _ensure_worker():
+    # Started lazily so each (forked) worker process gets its own thread
+    global _worker
+    with _lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_run, name="security-mailer", daemon=True)
+            _worker.start()
+
+def _next_item():
+    try:
+        return _queue.get(timeout=IDLE_TIMEOUT)
+    except queue.Empty:
+        return None
+
+def _run():
+    item = None
+    retried = False
+    while True:
+        if item is None:
+            item = _queue.get()
+        with _app.app_context():
+            try:
+                # One SMTP session for consecutive items; closed after IDLE_TIMEOUT
+                with mail.connect() as conn:
+                    while item is not None:
+                        try:
+                            send_reset_email(*item, connection=conn)
+                        except smtplib.SMTPServerDisconnected:
+                            raise
+                        except Exception as e:
+                            _app.logger.error("Reset email to %s failed: %s", item[0], e)
+                        item, retried = _next_item(), False
+            except smtplib.SMTPServerDisconnected as e:
+                # Reconnect and retry the pending item once
+                if item is not None and retried:
+                    _app.logger.error("Reset email to %s failed: %s", item[0], e)
+                    item = None
+                retried = item is not None
+            except Exception as e:
+                if item is not None:
+                    _app.logger.error("Reset email to %s failed: %s", item[0], e)
+                item, retried = None, False
@@ -2,11 +2,25 @@ import datetime as dt
 import secrets
 from sqlalchemy import Column, Integer, String, Boolean, DateTime
 from sqlalchemy.orm import validates
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHash
 from flask_login import UserMixin
 
 from . import Base
 
+# argon2id (memory-hard, native backend); werkzeug hashes are migrated on login
+_ph = PasswordHasher(time_cost=2, memory_cost=65536, parallelism=2)
+# Verified when the account does not exist, so that path costs the same as a real check
+_DUMMY_HASH = _ph.hash(secrets.token_urlsafe(16))
+
+def dummy_check_password(password: str) -> bool:
+    try:
+        _ph.verify(_DUMMY_HASH, password)
+    except (VerificationError, InvalidHash):
+        pass
+    return False
+
 class User(Base, UserMixin):
     __tablename__ = "users"
     id = Column(Integer, primary_key=True)
@@ -22,16 +36,31 @@ class User(Base, UserMixin):
     # 2FA
     totp_secret = Column(String(64), nullable=True)
     is_2fa_enabled = Column(Boolean, default=False)
+    last_totp_step = Column(Integer, default=0)  # last consumed TOTP time step (anti-replay)
+    totp_failed_attempts = Column(Integer, default=0)
+    totp_lock_until = Column(DateTime, nullable=True)
 
     created_at = Column(DateTime, default=dt.datetime.utcnow)
     updated_at = Column(DateTime, default=dt.datetime.utcnow, onupdate=dt.datetime.utcnow)
     last_login_at = Column(DateTime, nullable=True)
 
     def set_password(self, password: str):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = _ph.hash(password)
 
     def check_password(self, password: str) -> bool:
-        return check_password_hash(self.password_hash, password)
+        # On success the hash may be upgraded in place; the caller commits
+        if not self.password_hash.startswith("$argon2"):
+            if not check_password_hash(self.password_hash, password):
+                return False
+            self.set_password(password)
+            return True
+        try:
+            _ph.verify(self.password_hash, password)
+        except (VerificationError, InvalidHash):
+            return False
+        if _ph.check_needs_rehash(self.password_hash):
+            self.set_password(password)
+        return True
 
     def get_id(self):
         return str(self.id)
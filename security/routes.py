@@ -1,20 +1,25 @@
 import datetime as dt
 import io
 import base64
+import hmac
+import time
+from functools import lru_cache
 import pyotp
-import qrcode
+import segno
 from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app, abort
 from flask_login import login_user, logout_user, current_user, login_required
-from sqlalchemy import select
+from sqlalchemy import select, update, case, func
 from sqlalchemy.exc import IntegrityError
 from werkzeug.urls import url_parse
 
-from . import get_db
-from .models import User
+from . import db_session
+from .models import User, dummy_check_password
 from .forms import (LoginForm, TwoFAForm, CreateUserForm, UpdateUserForm,
                     ChangePasswordForm, ResetRequestForm, ResetPasswordForm)
 from .utils import admin_required
-from .email import generate_reset_token, verify_reset_token, send_reset_email
+from .email import (generate_reset_token, verify_reset_token, send_reset_emails,
+                    generate_2fa_token, verify_2fa_token)
+from . import mailer
 
 bp = Blueprint("security", __name__, url_prefix="")
 
@@ -22,27 +27,90 @@ bp = Blueprint("security", __name__, url_prefix="")
 def is_locked(user: User) -> bool:
     return bool(user.locked_until and dt.datetime.utcnow() < user.locked_until)
 
-def record_failed_login(user: User, lock_after=5, lock_minutes=10):
-    user.failed_logins = (user.failed_logins or 0) + 1
-    if user.failed_logins >= lock_after:
-        user.locked_until = dt.datetime.utcnow() + dt.timedelta(minutes=lock_minutes)
+def record_failed_login(session, user: User, lock_after=5, lock_minutes=10):
+    # Single UPDATE computed in SQL: atomic under concurrent failures, no ORM flush
+    failed = func.coalesce(User.failed_logins, 0) + 1
+    lock_at = dt.datetime.utcnow() + dt.timedelta(minutes=lock_minutes)
+    session.execute(
+        update(User).where(User.id == user.id)
+        .values(failed_logins=failed,
+                locked_until=case((failed >= lock_after, lock_at), else_=User.locked_until))
+        .execution_options(synchronize_session=False))
 
 def reset_failed_login(user: User):
     user.failed_logins = 0
     user.locked_until = None
 
+# Per account (not per IP): rotating IPs must not reset the 2FA budget
+def is_totp_locked(user: User) -> bool:
+    return bool(user.totp_lock_until and dt.datetime.utcnow() < user.totp_lock_until)
+
+def record_failed_totp(user: User, lock_after=5, lock_minutes=10):
+    user.totp_failed_attempts = (user.totp_failed_attempts or 0) + 1
+    if user.totp_failed_attempts >= lock_after:
+        user.totp_lock_until = dt.datetime.utcnow() + dt.timedelta(minutes=lock_minutes)
+
+def reset_failed_totp(user: User):
+    user.totp_failed_attempts = 0
+    user.totp_lock_until = None
+
+class _TOTP(pyotp.TOTP):
+    """pyotp.TOTP with the base32 secret decoded once (pyotp decodes it per code)."""
+    def __init__(self, secret: str, **kwargs):
+        super().__init__(secret, **kwargs)
+        self._key = super().byte_secret()
+
+    def byte_secret(self) -> bytes:
+        return self._key
+
+@lru_cache(maxsize=4096)
+def _totp_for(secret: str) -> pyotp.TOTP:
+    # Keyed by the secret itself: a regenerated secret simply gets a new entry
+    return _TOTP(secret)
+
+def verify_totp(user: User, code: str, valid_window=1) -> bool:
+    """Check the code against every step of the window (constant time) and
+    reject steps already consumed. On success stores the step; caller commits."""
+    totp = _totp_for(user.totp_secret)
+    now_step = int(time.time()) // totp.interval
+    code_b = (code or "").strip().encode("utf-8")
+    matched = None
+    for step in range(now_step - valid_window, now_step + valid_window + 1):
+        if hmac.compare_digest(totp.generate_otp(step).encode("ascii"), code_b):
+            matched = step
+    if matched is None or matched <= (user.last_totp_step or 0):
+        return False
+    user.last_totp_step = matched
+    return True
+
+@lru_cache(maxsize=256)
+def _qr_data_uri(otp_uri: str) -> str:
+    """QR SVG as data URI (segno, no PIL/PNG encode); the URI is fixed per secret,
+    so repeat visits skip the render."""
+    buf = io.BytesIO()
+    segno.make(otp_uri, error="l").save(buf, kind="svg", scale=5, xmldecl=False)
+    return "data:image/svg+xml;base64," + base64.b64encode(buf.getvalue()).decode("ascii")
+
+def _default_landing() -> str:
+    # Resolved once per app, on the first request (every blueprint is registered by then)
+    landing = current_app.extensions.get("security_landing")
+    if landing is None:
+        landing = url_for("main.index") if "main.index" in current_app.view_functions else "/"
+        current_app.extensions["security_landing"] = landing
+    return landing
+
 # ------------- Routes -------------
 
 @bp.route("/login", methods=["GET", "POST"])
 def login():
     if current_user.is_authenticated:
-        return redirect(url_for("main.index") if "main.index" in current_app.view_functions else "/")
+        return redirect(_default_landing())
     form = LoginForm()
     if form.validate_on_submit():
-        session = get_db()
-        try:
+        with db_session() as session:
             user = session.execute(select(User).where(User.username == form.username.data)).scalar_one_or_none()
             if not user or not user.is_active:
+                dummy_check_password(form.password.data)  # same timing as a wrong password
                 flash("Usuario/contraseña inválidos.", "danger")
                 return render_template("security/login.html", form=form), 401
 
@@ -51,7 +119,7 @@ def login():
                 return render_template("security/login.html", form=form), 403
 
             if not user.check_password(form.password.data):
-                record_failed_login(user)
+                record_failed_login(session, user)
                 session.commit()
                 flash("Usuario/contraseña inválidos.", "danger")
                 return render_template("security/login.html", form=form), 401
@@ -62,9 +130,9 @@ def login():
 
             # 2FA flow
             if user.is_2fa_enabled:
-                # Store pending user id in session (server-side session handled by Flask)
+                # Pending user kept in the session as a short-lived signed token; popped on success
                 from flask import session as flask_session
-                flask_session["pending_2fa_user_id"] = user.id
+                flask_session["pending_2fa"] = generate_2fa_token(user.id)
                 return redirect(url_for("security.verify_2fa"))
             else:
                 login_user(user, remember=form.remember.data, duration=current_app.config.get("REMEMBER_COOKIE_DURATION"))
@@ -72,10 +140,8 @@ def login():
                 session.commit()
                 next_page = request.args.get("next")
                 if not next_page or url_parse(next_page).netloc != "":
-                    next_page = url_for("main.index") if "main.index" in current_app.view_functions else "/"
+                    next_page = _default_landing()
                 return redirect(next_page)
-        finally:
-            session.close()
     return render_template("security/login.html", form=form)
 
 @bp.route("/logout")
@@ -87,30 +153,19 @@ def logout():
 @bp.route("/2fa/setup", methods=["GET", "POST"])
 @login_required
 def setup_2fa():
-    session = get_db()
-    try:
-        user = session.get(User, current_user.id)
-        if request.method == "POST":
-            # enable / disable handled via separate endpoints for clarity
-            pass
-
-        if not user.totp_secret:
+    # enable / disable handled via separate endpoints for clarity
+    # The user_loader already fetched the row this request: no second SELECT
+    user = current_user._get_current_object()
+    if not user.totp_secret:
+        with db_session() as session:
+            user = session.merge(user, load=False)
             user.totp_secret = pyotp.random_base32()
             session.commit()
 
-        issuer = current_app.config.get("SECURITY_ISSUER", "Incidencias")
-        otp_uri = pyotp.totp.TOTP(user.totp_secret).provisioning_uri(name=user.email, issuer_name=issuer)
-
-        # QR as data URI
-        img = qrcode.make(otp_uri)
-        buf = io.BytesIO()
-        img.save(buf, format="PNG")
-        b64 = base64.b64encode(buf.getvalue()).decode("ascii")
-        data_uri = "data:image/png;base64," + b64
+    issuer = current_app.config.get("SECURITY_ISSUER", "Incidencias")
+    otp_uri = _totp_for(user.totp_secret).provisioning_uri(name=user.email, issuer_name=issuer)
 
-        return render_template("security/setup_2fa.html", otp_uri=otp_uri, data_uri=data_uri, is_enabled=user.is_2fa_enabled)
-    finally:
-        session.close()
+    return render_template("security/setup_2fa.html", otp_uri=otp_uri, data_uri=_qr_data_uri(otp_uri), is_enabled=user.is_2fa_enabled)
 
 @bp.route("/2fa/enable", methods=["POST"])
 @login_required
@@ -119,102 +174,105 @@ def enable_2fa():
     if not form.validate_on_submit():
         flash("Código inválido.", "danger")
         return redirect(url_for("security.setup_2fa"))
-    session = get_db()
-    try:
-        user = session.get(User, current_user.id)
-        totp = pyotp.TOTP(user.totp_secret)
-        if not totp.verify(form.code.data, valid_window=1):
+    with db_session() as session:
+        user = session.merge(current_user._get_current_object(), load=False)
+        if not verify_totp(user, form.code.data):
             flash("Código 2FA incorrecto.", "danger")
             return redirect(url_for("security.setup_2fa"))
         user.is_2fa_enabled = True
         session.commit()
         flash("2FA habilitado.", "success")
         return redirect(url_for("security.setup_2fa"))
-    finally:
-        session.close()
 
 @bp.route("/2fa/disable", methods=["POST"])
 @login_required
 def disable_2fa():
-    session = get_db()
-    try:
-        user = session.get(User, current_user.id)
+    with db_session() as session:
+        user = session.merge(current_user._get_current_object(), load=False)
         user.is_2fa_enabled = False
         session.commit()
         flash("2FA deshabilitado.", "info")
         return redirect(url_for("security.setup_2fa"))
-    finally:
-        session.close()
 
 @bp.route("/2fa/verify", methods=["GET", "POST"])
 def verify_2fa():
     from flask import session as flask_session
-    pending_id = flask_session.get("pending_2fa_user_id")
-    if not pending_id:
+    token = flask_session.get("pending_2fa")
+    if not token:
+        return redirect(url_for("security.login"))
+    try:
+        pending_id = verify_2fa_token(token)
+    except Exception:
+        flask_session.pop("pending_2fa", None)
+        flash("Sesión de verificación inválida o expirada.", "danger")
         return redirect(url_for("security.login"))
     form = TwoFAForm()
     if form.validate_on_submit():
-        session = get_db()
-        try:
-            user = session.get(User, int(pending_id))
+        with db_session() as session:
+            user = session.get(User, pending_id)
             if not user or not user.is_2fa_enabled:
                 flash("Sesión inválida.", "danger")
                 return redirect(url_for("security.login"))
-            totp = pyotp.TOTP(user.totp_secret)
-            if not totp.verify(form.code.data, valid_window=1):
+            if is_totp_locked(user):
+                flash("Demasiados códigos incorrectos. Probá más tarde.", "danger")
+                return render_template("security/verify_2fa.html", form=form), 429
+            if not verify_totp(user, form.code.data):
+                record_failed_totp(user)
+                session.commit()
                 flash("Código 2FA incorrecto.", "danger")
                 return render_template("security/verify_2fa.html", form=form), 401
             # ok
+            reset_failed_totp(user)
             login_user(user, remember=False)
             user.last_login_at = dt.datetime.utcnow()
             session.commit()
-            flask_session.pop("pending_2fa_user_id", None)
-            next_page = url_for("main.index") if "main.index" in current_app.view_functions else "/"
+            flask_session.pop("pending_2fa", None)
+            next_page = _default_landing()
             return redirect(next_page)
-        finally:
-            session.close()
     return render_template("security/verify_2fa.html", form=form)
 
 # -------- Admin users --------
 
+USERS_PAGE_SIZE = 50
+
 @bp.route("/admin/users")
 @admin_required
 def users_list():
-    session = get_db()
-    try:
-        users = session.execute(select(User)).scalars().all()
-        return render_template("security/users_list.html", users=users)
-    finally:
-        session.close()
+    # Keyset pagination on id: each page is one indexed range scan, not a full load
+    after = request.args.get("after", 0, type=int)
+    size = min(max(request.args.get("size", USERS_PAGE_SIZE, type=int), 1), 500)
+    with db_session() as session:
+        stmt = (select(User.id, User.username, User.email, User.role, User.is_active, User.is_2fa_enabled)
+                .where(User.id > after).order_by(User.id).limit(size + 1))
+        users = session.execute(stmt).all()
+        next_after = users[size - 1].id if len(users) > size else None
+        return render_template("security/users_list.html", users=users[:size],
+                               next_after=next_after, size=size, is_first=after == 0)
 
 @bp.route("/admin/users/new", methods=["GET", "POST"])
 @admin_required
 def users_new():
     form = CreateUserForm()
     if form.validate_on_submit():
-        session = get_db()
         try:
-            u = User(username=form.username.data.strip(),
-                     email=form.email.data.strip(),
-                     role=form.role.data,
-                     is_active=form.is_active.data)
-            u.set_password(form.password.data)
-            session.add(u)
-            session.commit()
+            with db_session() as session:
+                u = User(username=form.username.data.strip(),
+                         email=form.email.data.strip(),
+                         role=form.role.data,
+                         is_active=form.is_active.data)
+                u.set_password(form.password.data)
+                session.add(u)
+                session.commit()
             flash("Usuario creado.", "success")
             return redirect(url_for("security.users_list"))
         except IntegrityError:
-            session.rollback()
             flash("Usuario o email ya existen.", "danger")
-        finally:
-            session.close()
     return render_template("security/users_new.html", form=form)
 
 @bp.route("/admin/users/<int:user_id>/edit", methods=["GET", "POST"])
 @admin_required
 def users_edit(user_id):
-    session = get_db()
-    try:
+    with db_session() as session:
         u = session.get(User, user_id)
         if not u:
             abort(404)
@@ -227,15 +285,12 @@ def users_edit(user_id):
             flash("Usuario actualizado.", "success")
             return redirect(url_for("security.users_list"))
         return render_template("security/users_edit.html", form=form, user=u)
-    finally:
-        session.close()
 
 @bp.route("/admin/users/<int:user_id>/password", methods=["POST"])
 @admin_required
 def users_reset_password(user_id):
     # Admin forces password change (sets a temporary)
-    session = get_db()
-    try:
+    with db_session() as session:
         u = session.get(User, user_id)
         if not u:
             abort(404)
@@ -244,8 +299,29 @@ def users_reset_password(user_id):
         session.commit()
         flash(f"Contraseña temporal: {tmp}", "info")
         return redirect(url_for("security.users_list"))
-    finally:
-        session.close()
+
+@bp.route("/admin/users/bulk_reset", methods=["POST"])
+@admin_required
+def users_bulk_reset():
+    # Reset links for the selected users, all sent over one SMTP session
+    ids = request.form.getlist("user_ids", type=int)
+    if not ids:
+        flash("No se seleccionaron usuarios.", "info")
+        return redirect(url_for("security.users_list"))
+    with db_session() as session:
+        emails = session.execute(select(User.email).where(User.id.in_(ids))).scalars().all()
+    pairs = [(email, url_for("security.reset_with_token", token=generate_reset_token(email), _external=True))
+             for email in emails]
+    try:
+        sent, failed = send_reset_emails(pairs)
+    except Exception as e:
+        flash(f"No se pudo conectar al servidor SMTP: {e}", "danger")
+        return redirect(url_for("security.users_list"))
+    if failed:
+        flash(f"Enlaces enviados: {sent}. Fallaron: {', '.join(failed)}.", "warning")
+    else:
+        flash(f"Enlaces enviados: {sent}.", "success")
+    return redirect(url_for("security.users_list"))
 
 # -------- Password reset by email --------
 
@@ -253,22 +329,22 @@ def users_reset_password(user_id):
 def reset_request():
     form = ResetRequestForm()
     if form.validate_on_submit():
-        session = get_db()
-        try:
-            user = session.execute(select(User).where(User.email == form.email.data.strip())).scalar_one_or_none()
+        with db_session() as session:
+            email = form.email.data.strip()
+            user = session.execute(select(User).where(User.email == email)).scalar_one_or_none()
+            # Token built on both branches so response time does not reveal the account
+            token = generate_reset_token(user.email if user else email)
             if user:
-                token = generate_reset_token(user.email)
                 reset_url = url_for("security.reset_with_token", token=token, _external=True)
-                try:
-                    send_reset_email(user.email, reset_url)
+                if current_app.config.get("MAIL_SERVER"):
+                    # SMTP runs on the mailer thread; the response does not wait for it
+                    mailer.enqueue(user.email, reset_url)
                     flash("Se envió un email con instrucciones si el correo existe.", "info")
-                except Exception as e:
+                else:
                     # fallback: mostrar link (solo si no hay SMTP configurado)
                     flash(f"SMTP no configurado. Usá este enlace manualmente: {reset_url}", "warning")
             else:
                 flash("Se envió un email con instrucciones si el correo existe.", "info")
-        finally:
-            session.close()
     return render_template("security/reset_request.html", form=form)
 
 @bp.route("/reset/<token>", methods=["GET", "POST"])
@@ -281,8 +357,7 @@ def reset_with_token(token):
         flash("Token inválido o expirado.", "danger")
         return redirect(url_for("security.reset_request"))
     if form.validate_on_submit():
-        session = get_db()
-        try:
+        with db_session() as session:
             user = session.execute(select(User).where(User.email == email)).scalar_one_or_none()
             if not user:
                 flash("Usuario no encontrado.", "danger")
@@ -291,6 +366,4 @@ def reset_with_token(token):
             session.commit()
             flash("Contraseña restablecida. Ingresá con tu nueva clave.", "success")
             return redirect(url_for("security.login"))
-        finally:
-            session.close()
     return render_template("security/reset_with_token.html", form=form)
@@ -0,0 +1,61 @@
+import os
+import re
+
+import pytest
+from flask import Flask
+from jinja2 import ChoiceLoader, DictLoader, FileSystemLoader
+
+import security
+from security.models import User
+
+TEMPLATES = os.path.join(os.path.dirname(__file__), '..', 'security', 'templates')
+CSRF_RE = re.compile(r'<form id="bulk-reset".*?name="csrf_token" value="([^"]+)"', re.S)
+
+
+@pytest.fixture
+def client():
+    app = Flask(__name__)
+    app.config.update(
+        SECRET_KEY='test',
+        SECURITY_DATABASE_URI='sqlite://',
+        MAIL_SERVER='localhost',
+        MAIL_DEFAULT_SENDER='no-reply@localhost',
+        MAIL_SUPPRESS_SEND=True,
+    )
+    # base.html mínimo: sólo interesa el formulario que renderiza cada plantilla
+    app.jinja_loader = ChoiceLoader([
+        DictLoader({'base.html': '{% block content %}{% endblock %}'}),
+        FileSystemLoader(TEMPLATES),
+    ])
+    security.init_app(app)
+
+    session = security.get_db()
+    admin = User(username='admin', email='admin@example.com', role='admin', is_active=True)
+    admin.set_password('Cambiar123!')
+    session.add(admin)
+    session.commit()
+    admin_id = admin.id
+    session.close()
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['_user_id'] = str(admin_id)
+        sess['_fresh'] = True
+    client.admin_id = admin_id
+    return client
+
+
+def test_bulk_reset_form_posts_csrf_token(client):
+    page = client.get('/admin/users')
+    assert page.status_code == 200
+    token = CSRF_RE.search(page.get_data(as_text=True)).group(1)
+
+    res = client.post('/admin/users/bulk_reset', data={'csrf_token': token, 'user_ids': [client.admin_id]})
+    assert res.status_code == 302
+    with client.session_transaction() as sess:
+        assert ('success', 'Enlaces enviados: 1.') in sess['_flashes']
+
+
+def test_bulk_reset_without_csrf_token_is_rejected(client):
+    res = client.post('/admin/users/bulk_reset', data={'user_ids': [client.admin_id]})
+    assert res.status_code == 400